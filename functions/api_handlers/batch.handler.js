@@ -8,6 +8,7 @@ const { performRecalculation } = require('../performRecalculation');
 const { populateSettlementFxRate } = require('../services/transaction.service');
 const { calculateGroupOnDemandCore } = require('./group.handler');
 const { updateBenchmarkCore } = require('./portfolio.handler');
+const { toCanonicalSymbol } = require('../calculation/helpers');
 
 
 /**
@@ -44,6 +45,7 @@ async function processBatchActions(uid, actions) {
             delete txData.newGroups;
             delete txData._special_action;
             delete txData.id;
+            txData.symbol = toCanonicalSymbol(txData.symbol);
             txData = await populateSettlementFxRate(txData);
             
             statements.push({
@@ -82,6 +84,10 @@ async function processBatchActions(uid, actions) {
             delete cleanPayload.groupInclusions;
             delete cleanPayload.newGroups;
             delete cleanPayload._special_action;
+            // 交易、拆股與股利的代碼一律以標準形式寫入，與 Python 腳本不再套用 upper() 的查詢一致
+            if (['transaction', 'split', 'dividend'].includes(entity) && 'symbol' in cleanPayload) {
+                cleanPayload.symbol = toCanonicalSymbol(cleanPayload.symbol);
+            }
             const tableMap = { 'transaction': 'transactions', 'split': 'splits', 'dividend': 'user_dividends', 'group': 'groups' };
             const tableName = tableMap[entity];
             if (!tableName) throw new Error(`Unsupported entity type: ${entity}`);
@@ -4,6 +4,7 @@
 
 const { d1Client } = require('../d1.client');
 const { performRecalculation } = require('../performRecalculation');
+const { toCanonicalSymbol } = require('../calculation/helpers');
 
 const ALL_GROUP_ID = 'all';
 
@@ -16,7 +17,7 @@ const ALL_GROUP_ID = 'all';
 async function updateBenchmarkCore(uid, benchmarkSymbol) {
     await d1Client.query(
         'INSERT OR REPLACE INTO controls (uid, key, value) VALUES (?, ?, ?)',
-        [uid, 'benchmarkSymbol', benchmarkSymbol.toUpperCase()]
+        [uid, 'benchmarkSymbol', toCanonicalSymbol(benchmarkSymbol)]
     );
     // 更新 Benchmark 會觸發對 'all' 群組的重算
     await performRecalculation(uid, null, false);
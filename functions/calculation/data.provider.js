@@ -5,13 +5,26 @@
 
 const yahooFinance = require("yahoo-finance2").default;
 const { d1Client } = require('../d1.client');
+const { toCanonicalSymbol } = require('./helpers');
 
 const currencyToFx = { USD: "TWD=X", HKD: "HKDTWD=X", JPY: "JPYTWD=X" };
 
+/**
+ * 讀取 intraday_quotes 覆蓋表中的盤中報價 (每個標的一列)。
+ * 覆蓋表由 Python 更新腳本建立，尚未建立時視為沒有任何盤中報價。
+ */
+async function getIntradayQuotes(symbols) {
+    if (!symbols || symbols.length === 0) return [];
+    const placeholders = symbols.map(() => '?').join(',');
+    return d1Client.query(`SELECT symbol, date, price FROM intraday_quotes WHERE symbol IN (${placeholders})`, symbols)
+        .catch(() => []);
+}
+
 /**
  * 根據指定日期範圍，從 Yahoo Finance 抓取歷史數據並儲存至 D1
  */
 async function fetchAndSaveMarketDataRange(symbol, startDate, endDate) {
+    symbol = toCanonicalSymbol(symbol);
     try {
         const hist = await yahooFinance.historical(symbol, { period1: startDate, period2: endDate, interval: '1d', autoAdjust: false, backAdjust: false });
         if (!hist || hist.length === 0) return [];
@@ -40,6 +53,7 @@ async function fetchAndSaveMarketDataRange(symbol, startDate, endDate) {
  */
 async function ensureDataCoverage(symbol, requiredStartDate) {
     if (!symbol || !requiredStartDate) return;
+    symbol = toCanonicalSymbol(symbol);
     const coverageData = await d1Client.query('SELECT earliest_date FROM market_data_coverage WHERE symbol = ?', [symbol]);
     const today = new Date().toISOString().split('T')[0];
 
@@ -96,7 +110,14 @@ async function ensureDataFreshness(symbols) {
     const targetDateStr = targetDate.toISOString().split('T')[0];
     // ========================= 【核心修正 - 結束】 =========================
 
-    const fetchPromises = symbols.map(async (symbol) => {
+    const canonicalSymbols = symbols.map(toCanonicalSymbol);
+    const intradayQuotes = await getIntradayQuotes(canonicalSymbols);
+    const intradayDates = Object.fromEntries(intradayQuotes.map(q => [q.symbol, q.date.split('T')[0]]));
+
+    const fetchPromises = canonicalSymbols.map(async (symbol) => {
+        // 盤中報價已涵蓋目標日期時，不再把未收盤的 K 線寫入正式歷史表
+        if (intradayDates[symbol] && intradayDates[symbol] >= targetDateStr) return;
+
         const isFx = symbol.includes("=");
         const tableName = isFx ? "exchange_rates" : "price_history";
         const result = await d1Client.query(`SELECT MAX(date) as latest_date FROM ${tableName} WHERE symbol = ?`, [symbol]);
@@ -179,30 +200,71 @@ async function getMarketDataFromDb(txs, benchmarkSymbol) {
     const requiredFxSymbols = currencies.map(c => currencyToFx[c]).filter(Boolean);
     const requiredStockSymbols = [...new Set([...symbolsInPortfolio, benchmarkSymbol.toUpperCase()])].filter(Boolean);
 
-    const promises = [];
-    if (requiredStockSymbols.length > 0) {
-        const p1 = requiredStockSymbols.map(() => '?').join(',');
-        promises.push(d1Client.query(`SELECT symbol, date, price FROM price_history WHERE symbol IN (${p1})`, requiredStockSymbols));
-        promises.push(d1Client.query(`SELECT symbol, date, dividend FROM dividend_history WHERE symbol IN (${p1})`, requiredStockSymbols));
-    } else {
-        promises.push(Promise.resolve([]), Promise.resolve([]));
-    }
+    const allSymbols = [...requiredStockSymbols, ...requiredFxSymbols];
+    const p1 = requiredStockSymbols.map(() => '?').join(',');
+    const p2 = requiredFxSymbols.map(() => '?').join(',');
+    const dividendsPromise = requiredStockSymbols.length > 0
+        ? d1Client.query(`SELECT symbol, date, dividend FROM dividend_history WHERE symbol IN (${p1})`, requiredStockSymbols)
+        : Promise.resolve([]);
+    const fxPromise = requiredFxSymbols.length > 0
+        ? d1Client.query(`SELECT symbol, date, price FROM exchange_rates WHERE symbol IN (${p2})`, requiredFxSymbols)
+        : Promise.resolve([]);
+    const intradayPromise = getIntradayQuotes(allSymbols);
 
-    if (requiredFxSymbols.length > 0) {
-        const p2 = requiredFxSymbols.map(() => '?').join(',');
-        promises.push(d1Client.query(`SELECT symbol, date, price FROM exchange_rates WHERE symbol IN (${p2})`, requiredFxSymbols));
-    } else {
-        promises.push(Promise.resolve([]));
+    // 由 Python 更新腳本預先對齊匯率的台幣價格序列為主要價格來源；資料表尚未建立時視為沒有任何標的被涵蓋
+    const pricesTwdFlat = requiredStockSymbols.length > 0
+        ? await d1Client.query(`SELECT symbol, date, currency, price, price_twd FROM price_history_twd WHERE symbol IN (${p1})`, requiredStockSymbols).catch(() => [])
+        : [];
+    const twdRange = {};
+    pricesTwdFlat.forEach(row => {
+        const dateStr = row.date.split('T')[0];
+        const range = twdRange[row.symbol] || (twdRange[row.symbol] = { first: dateStr, last: dateStr });
+        if (dateStr < range.first) range.first = dateStr;
+        if (dateStr > range.last) range.last = dateStr;
+    });
+    const uncoveredSymbols = requiredStockSymbols.filter(s => !twdRange[s]);
+    const coveredSymbols = requiredStockSymbols.filter(s => twdRange[s]);
+
+    // 退回路徑：未被涵蓋的標的讀取完整 price_history；已涵蓋的標的只讀取台幣序列範圍之外 (尚未物化) 的日期
+    const pricePromises = [];
+    if (uncoveredSymbols.length > 0) {
+        pricePromises.push(d1Client.query(`SELECT symbol, date, price FROM price_history WHERE symbol IN (${uncoveredSymbols.map(() => '?').join(',')})`, uncoveredSymbols));
+    }
+    const RANGE_CHUNK_SIZE = 30; // 每個標的 3 個參數，維持在 D1 單一語句 100 個參數的上限內
+    for (let i = 0; i < coveredSymbols.length; i += RANGE_CHUNK_SIZE) {
+        const chunk = coveredSymbols.slice(i, i + RANGE_CHUNK_SIZE);
+        const conditions = chunk.map(() => '(symbol = ? AND (date < ? OR date > ?))').join(' OR ');
+        const params = chunk.flatMap(s => [s, twdRange[s].first, twdRange[s].last]);
+        pricePromises.push(d1Client.query(`SELECT symbol, date, price FROM price_history WHERE ${conditions}`, params));
     }
 
-    const [stockPricesFlat, stockDividendsFlat, fxRatesFlat] = await Promise.all(promises);
-    const allSymbols = [...requiredStockSymbols, ...requiredFxSymbols];
+    const [stockPricesFlat, stockDividendsFlat, fxRatesFlat, intradayQuotes] = await Promise.all([
+        Promise.all(pricePromises).then(results => results.flat()),
+        dividendsPromise,
+        fxPromise,
+        intradayPromise
+    ]);
 
     const marketData = allSymbols.reduce((acc, symbol) => ({ ...acc, [symbol]: { prices: {}, dividends: {} } }), {});
 
+    pricesTwdFlat.forEach(row => {
+        const entry = marketData[row.symbol];
+        if (!entry) return;
+        const dateStr = row.date.split('T')[0];
+        entry.prices[dateStr] = row.price;
+        entry.pricesTWD = entry.pricesTWD || {};
+        entry.pricesTWD[dateStr] = { currency: row.currency, price: row.price, priceTWD: row.price_twd };
+    });
     stockPricesFlat.forEach(row => { marketData[row.symbol].prices[row.date.split('T')[0]] = row.price; });
     stockDividendsFlat.forEach(row => { marketData[row.symbol].dividends[row.date.split('T')[0]] = row.dividend; });
     fxRatesFlat.forEach(row => { marketData[row.symbol].prices[row.date.split('T')[0]] = row.price; });
+    // 將盤中報價疊加在已確定的歷史之上；同一日期若已有正式收盤價，則以正式數據為準
+    intradayQuotes.forEach(row => {
+        const dateStr = row.date.split('T')[0];
+        if (marketData[row.symbol] && marketData[row.symbol].prices[dateStr] === undefined) {
+            marketData[row.symbol].prices[dateStr] = row.price;
+        }
+    });
     
     requiredFxSymbols.forEach(fxSymbol => {
         if (marketData[fxSymbol]) {
@@ -218,4 +280,5 @@ module.exports.fetchAndSaveMarketDataRange = fetchAndSaveMarketDataRange;
 module.exports.ensureDataCoverage = ensureDataCoverage;
 module.exports.ensureDataFreshness = ensureDataFreshness;
 module.exports.getMarketDataFromDb = getMarketDataFromDb;
+module.exports.getIntradayQuotes = getIntradayQuotes;
 module.exports.ensureAllSymbolsData = ensureAllSymbolsData;
@@ -11,6 +11,14 @@ const toDate = (v) => {
     return d;
 };
 
+/**
+ * 將股票代碼正規化為資料庫中使用的標準形式 (去除空白並轉為大寫)。
+ * 所有寫入路徑都必須經過此函式，讀取時才能直接使用 `symbol = ?` 命中 (symbol, date) 主鍵索引。
+ */
+const toCanonicalSymbol = (symbol) => {
+    return symbol ? String(symbol).trim().toUpperCase() : symbol;
+};
+
 const isTwStock = (symbol) => {
     return symbol ? (symbol.toUpperCase().endsWith('.TW') || symbol.toUpperCase().endsWith('.TWO')) : false;
 };
@@ -70,6 +78,7 @@ function findFxRate(market, currency, date, tolerance = 15) {
 
 module.exports = {
     toDate,
+    toCanonicalSymbol,
     isTwStock,
     getTotalCost,
     findNearest,
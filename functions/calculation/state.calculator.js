@@ -166,7 +166,14 @@ function dailyValue(state, market, date, allEvts) {
         );
         const adjustmentRatio = futureSplits.reduce((acc, split) => acc * split.ratio, 1);
         const unadjustedPrice = price * adjustmentRatio;
-        
+
+        // 優先使用預先換算好的台幣價格；僅在日期、幣別與原幣價格皆一致時採用，否則即時對齊匯率
+        const materialized = market[sym]?.pricesTWD?.[priceDate];
+        if (materialized && priceDate === toDate(date).toISOString().split('T')[0] && materialized.currency === s.currency && materialized.price === price) {
+            totalPortfolioValue += (qty * materialized.priceTWD * adjustmentRatio);
+            continue;
+        }
+
         const fx = findFxRate(market, s.currency, date);
 
         totalPortfolioValue += (qty * unadjustedPrice * (s.currency === "TWD" ? 1 : fx));
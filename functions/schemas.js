@@ -1,8 +1,9 @@
 const { z } = require("zod");
+const { toCanonicalSymbol } = require('./calculation/helpers');
 
 const transactionSchema = z.object({
     date: z.string().regex(/^\d{4}-\d{2}-\d{2}$/),
-    symbol: z.string().min(1).transform(val => val.toUpperCase().trim()),
+    symbol: z.string().min(1).transform(toCanonicalSymbol),
     type: z.enum(['buy', 'sell']),
     quantity: z.number().positive(),
     price: z.number().positive(),
@@ -13,13 +14,13 @@ const transactionSchema = z.object({
 
 const splitSchema = z.object({
     date: z.string().regex(/^\d{4}-\d{2}-\d{2}$/),
-    symbol: z.string().min(1).transform(val => val.toUpperCase().trim()),
+    symbol: z.string().min(1).transform(toCanonicalSymbol),
     ratio: z.number().positive(),
 });
 
 const userDividendSchema = z.object({
     id: z.string().uuid().optional(),
-    symbol: z.string(),
+    symbol: z.string().transform(toCanonicalSymbol),
     ex_dividend_date: z.string().regex(/^\d{4}-\d{2}-\d{2}$/),
     pay_date: z.string().regex(/^\d{4}-\d{2}-\d{2}$/),
     quantity_at_ex_date: z.number(),
@@ -1,13 +1,17 @@
 # =========================================================================================
-# == Python 每日增量更新腳本 (v7.1 - Atomic Intraday Update)
+# == Python 每日增量更新腳本 (v7.9 - Market Data Snapshot File)
 # =========================================================================================
 
 import os
+import argparse
+import socket
+import threading
 import yfinance as yf
 import requests
 import json
 from datetime import datetime, timedelta, time
 import time as time_sleep
+import numpy as np
 import pandas as pd
 import pytz
 
@@ -16,6 +20,19 @@ D1_WORKER_URL = os.environ.get("D1_WORKER_URL")
 D1_API_KEY = os.environ.get("D1_API_KEY")
 GCP_API_URL = os.environ.get("GCP_API_URL")
 GCP_API_KEY = D1_API_KEY
+# 缺口掃描只回看最近 N 天，更早的缺漏交由週末完整校驗處理
+GAP_SCAN_LOOKBACK_DAYS = int(os.environ.get("GAP_SCAN_LOOKBACK_DAYS", "365"))
+# 補抓後仍無數據的日期 (停牌、資料源缺漏) 記錄於 gap_scan_misses，N 天內不再重試
+GAP_SCAN_MISS_RETRY_DAYS = int(os.environ.get("GAP_SCAN_MISS_RETRY_DAYS", "30"))
+# 常駐盤中輪詢模式 (--daemon) 的報價輪詢間隔與目標列表刷新間隔
+INTRADAY_POLL_INTERVAL_SECONDS = int(os.environ.get("INTRADAY_POLL_INTERVAL_SECONDS", "60"))
+INTRADAY_TARGET_REFRESH_SECONDS = int(os.environ.get("INTRADAY_TARGET_REFRESH_SECONDS", "1800"))
+# 執行租約 (run_leases) 的效期、週末替換前等待每日更新結束的上限，以及等待時的檢查間隔
+RUN_LEASE_TTL_SECONDS = int(os.environ.get("RUN_LEASE_TTL_SECONDS", "600"))
+RUN_LEASE_DRAIN_TIMEOUT_SECONDS = int(os.environ.get("RUN_LEASE_DRAIN_TIMEOUT_SECONDS", "1800"))
+RUN_LEASE_POLL_SECONDS = int(os.environ.get("RUN_LEASE_POLL_SECONDS", "30"))
+# 設定後，每次成功執行結束時輸出 (或增量更新) 欄式市場數據快照檔 (.npz)
+MARKET_SNAPSHOT_PATH = os.environ.get("MARKET_SNAPSHOT_PATH")
 
 def robust_request(func, max_retries=3, delay=5, name="Request"):
     for attempt in range(1, max_retries + 1):
@@ -55,14 +72,115 @@ def d1_batch(statements, api_key=None):
     success = robust_request(batch_func, name=f"D1 Batch ({len(statements)} statements)")
     return success if success is not None else False
 
+def canonical_symbol(symbol):
+    """
+    將股票代碼正規化為資料庫中的標準形式 (去除空白並轉為大寫)。
+    所有寫入皆使用此形式，查詢因此可直接以 `symbol IN (...)` 命中 (symbol, date) 主鍵索引，不需在欄位上套用 upper()。
+    """
+    return symbol.strip().upper() if symbol else symbol
+
+# ========================= 【執行租約 - 開始】 =========================
+# == 新增：以 D1 中的 run_leases 表協調每日、常駐盤中與週末三種入口，避免重疊的排程重複下載、
+# == 爭用 D1，或在週末腳本替換 price_history 時寫入正在被替換的資料表
+# =========================================================================================
+DAILY_LEASE = "market_data_daily"
+INTRADAY_DAEMON_LEASE = "intraday_daemon"
+WEEKEND_LEASE = "weekend_refresh"
+# 宇宙預熱只增量寫入正式表、不替換資料表，使用獨立租約，不阻擋每日與盤中更新
+PREWARM_LEASE = "universe_prewarm"
+RUN_LEASES_DDL = "CREATE TABLE IF NOT EXISTS run_leases (lease_name TEXT PRIMARY KEY, holder TEXT, acquired_at TEXT, heartbeat_at TEXT, expires_at TEXT);"
+
+def lease_timestamp(offset_seconds=0):
+    """租約時間一律使用 UTC ISO 字串，可直接以字串比較先後"""
+    return (datetime.utcnow() + timedelta(seconds=offset_seconds)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def default_lease_holder():
+    """以 CI 執行編號 (或主機名稱) 加上程序編號識別租約持有者"""
+    return f"{os.environ.get('GITHUB_RUN_ID') or socket.gethostname()}-{os.getpid()}"
+
+def get_active_lease(lease_name):
+    """回傳尚未過期的租約紀錄；沒有人持有或已過期時回傳 None"""
+    rows = d1_query("SELECT * FROM run_leases WHERE lease_name = ? AND expires_at >= ?", [lease_name, lease_timestamp()], api_key=D1_API_KEY)
+    return rows[0] if rows else None
+
+def acquire_run_lease(lease_name, holder):
+    """
+    嘗試取得租約：只有在租約不存在、已過期或本來就由同一持有者持有時才會成功 (同一持有者可重複取得，用於跨 CI job 延續租約)。
+    :return: True 代表取得成功；False 代表有其他仍在心跳中的執行正在進行
+    """
+    now_str = lease_timestamp()
+    statements = [
+        {"sql": RUN_LEASES_DDL},
+        {"sql": """
+            INSERT INTO run_leases (lease_name, holder, acquired_at, heartbeat_at, expires_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(lease_name) DO UPDATE SET
+                holder = excluded.holder,
+                acquired_at = CASE WHEN run_leases.holder = excluded.holder THEN run_leases.acquired_at ELSE excluded.acquired_at END,
+                heartbeat_at = excluded.heartbeat_at,
+                expires_at = excluded.expires_at
+            WHERE run_leases.holder = excluded.holder OR run_leases.expires_at < excluded.heartbeat_at
+        """, "params": [lease_name, holder, now_str, now_str, lease_timestamp(RUN_LEASE_TTL_SECONDS)]}
+    ]
+    if not d1_batch(statements, api_key=D1_API_KEY):
+        print(f"FATAL: 無法存取 run_leases，視為未取得租約 {lease_name}。")
+        return False
+    current = get_active_lease(lease_name)
+    if current and current.get('holder') == holder:
+        print(f"已取得執行租約 {lease_name} (持有者: {holder}，有效至 {current.get('expires_at')})。")
+        return True
+    if current:
+        print(f"租約 {lease_name} 正由 {current.get('holder')} 持有 (最後心跳 {current.get('heartbeat_at')}，有效至 {current.get('expires_at')})。")
+    return False
+
+def renew_run_lease(lease_name, holder):
+    """心跳：延長自己持有的租約效期"""
+    return d1_batch([{
+        "sql": "UPDATE run_leases SET heartbeat_at = ?, expires_at = ? WHERE lease_name = ? AND holder = ?",
+        "params": [lease_timestamp(), lease_timestamp(RUN_LEASE_TTL_SECONDS), lease_name, holder]
+    }], api_key=D1_API_KEY)
+
+def release_run_lease(lease_name, holder):
+    """釋放自己持有的租約，讓等待中的執行可以立即接手"""
+    if d1_batch([{"sql": "DELETE FROM run_leases WHERE lease_name = ? AND holder = ?", "params": [lease_name, holder]}], api_key=D1_API_KEY):
+        print(f"已釋放執行租約 {lease_name}。")
+
+def start_lease_heartbeat(lease_name, holder):
+    """
+    在背景執行緒中每 RUN_LEASE_TTL_SECONDS / 3 秒更新一次心跳，程序崩潰時租約會在效期後自然失效。
+    :return: threading.Event，set() 後心跳停止
+    """
+    stop_event = threading.Event()
+    def heartbeat_loop():
+        while not stop_event.wait(max(RUN_LEASE_TTL_SECONDS // 3, 1)):
+            if not renew_run_lease(lease_name, holder):
+                print(f"警告: 租約 {lease_name} 心跳更新失敗。")
+    threading.Thread(target=heartbeat_loop, name=f"lease-heartbeat-{lease_name}", daemon=True).start()
+    return stop_event
+
+def wait_for_lease_drain(lease_name, timeout_seconds=None):
+    """等待其他執行持有的租約釋放或過期 (週末替換資料表前等待每日更新結束)"""
+    timeout_seconds = RUN_LEASE_DRAIN_TIMEOUT_SECONDS if timeout_seconds is None else timeout_seconds
+    deadline = time_sleep.monotonic() + timeout_seconds
+    while True:
+        current = get_active_lease(lease_name)
+        if not current:
+            return True
+        if time_sleep.monotonic() >= deadline:
+            print(f"FATAL: 等待租約 {lease_name} (持有者: {current.get('holder')}) 釋放逾時 ({timeout_seconds} 秒)。")
+            return False
+        print(f"租約 {lease_name} 仍由 {current.get('holder')} 持有，{RUN_LEASE_POLL_SECONDS} 秒後重新檢查...")
+        time_sleep.sleep(RUN_LEASE_POLL_SECONDS)
+
+# ========================= 【執行租約 - 結束】 =========================
+
 def get_update_targets():
     print("正在全面獲取所有需要更新的金融商品列表...")
     all_symbols, currency_to_fx = set(), {"USD": "TWD=X", "HKD": "HKDTWD=X", "JPY": "JPYTWD=X"}
     
-    holdings_sql = "SELECT DISTINCT upper(symbol) as symbol FROM holdings"
+    holdings_sql = "SELECT DISTINCT symbol FROM holdings"
     holdings_results = d1_query(holdings_sql, api_key=D1_API_KEY)
     if holdings_results:
-        for row in holdings_results: all_symbols.add(row['symbol'])
+        for row in holdings_results: all_symbols.add(canonical_symbol(row['symbol']))
             
     currencies_sql = "SELECT DISTINCT upper(currency) as currency FROM transactions"
     currencies_results = d1_query(currencies_sql, api_key=D1_API_KEY)
@@ -71,10 +189,10 @@ def get_update_targets():
             currency = row.get('currency')
             if currency in currency_to_fx: all_symbols.add(currency_to_fx[currency])
 
-    benchmark_sql = "SELECT DISTINCT upper(value) AS symbol FROM controls WHERE key = 'benchmarkSymbol'"
+    benchmark_sql = "SELECT DISTINCT value AS symbol FROM controls WHERE key = 'benchmarkSymbol'"
     benchmark_results = d1_query(benchmark_sql, api_key=D1_API_KEY)
     if benchmark_results:
-        for row in benchmark_results: all_symbols.add(row['symbol'])
+        for row in benchmark_results: all_symbols.add(canonical_symbol(row['symbol']))
     
     symbols_list = list(filter(None, all_symbols))
     
@@ -112,6 +230,16 @@ def get_current_market_session():
         return 'CLOSED'
 
 
+def get_intraday_symbols(all_symbols, session):
+    """依市場時段篩選需要進行盤中更新的標的"""
+    if session == 'TPE':
+        print("\n篩選目標：僅處理台股 (.TW, .TWO) 及匯率相關標的進行盤中更新。")
+        return [s for s in all_symbols if s.upper().endswith(('.TW', '.TWO')) or '=' in s]
+    if session == 'NYSE':
+        print("\n篩選目標：僅處理非台股的美股及其他國際市場標的進行盤中更新。")
+        return [s for s in all_symbols if not s.upper().endswith(('.TW', '.TWO'))]
+    return []
+
 def fetch_intraday_prices(symbols):
     print("\n--- 【即時更新階段】開始抓取盤中最新價格 ---")
     if not symbols: 
@@ -182,6 +310,48 @@ def fetch_intraday_prices(symbols):
     
     return latest_prices
 
+INTRADAY_QUOTES_DDL = "CREATE TABLE IF NOT EXISTS intraday_quotes (symbol TEXT PRIMARY KEY, date TEXT, price REAL, updated_at TEXT);"
+
+def build_intraday_quote_upserts(latest_prices_info):
+    """
+    將盤中價格轉為 intraday_quotes 覆蓋表的寫入語句 (每個標的只有一列)。
+    盤中報價屬於暫定數據，不寫入 price_history/exchange_rates，由讀取端疊加在已確定的歷史之上，並於下一次每日更新時轉正。
+    """
+    updated_at = datetime.now(pytz.utc).isoformat()
+    statements = [{"sql": INTRADAY_QUOTES_DDL}]
+    for symbol, info in latest_prices_info.items():
+        params = [canonical_symbol(symbol), info['date'], float(info['price']), updated_at]
+        print(f"  [排隊寫入] {params[0]} -> {params}")
+        statements.append({
+            "sql": "INSERT INTO intraday_quotes (symbol, date, price, updated_at) VALUES (?, ?, ?, ?) ON CONFLICT(symbol) DO UPDATE SET date = excluded.date, price = excluded.price, updated_at = excluded.updated_at;",
+            "params": params
+        })
+    return statements
+
+def load_intraday_quotes():
+    """讀取目前 intraday_quotes 覆蓋表的內容，格式與 fetch_intraday_prices 的回傳值相同"""
+    d1_batch([{"sql": INTRADAY_QUOTES_DDL}], api_key=D1_API_KEY)
+    rows = d1_query("SELECT symbol, date, price FROM intraday_quotes", api_key=D1_API_KEY)
+    return {row['symbol']: {"price": row['price'], "date": row['date'].split('T')[0]} for row in rows}
+
+def promote_intraday_quotes():
+    """
+    將日期早於今天的盤中報價轉正：歷史數據階段已寫入的正式收盤價優先保留 (INSERT OR IGNORE)，
+    只有 yfinance 未提供收盤價的日期才以最後一筆盤中報價補上，之後從覆蓋表中移除。
+    """
+    today_str = datetime.now().strftime('%Y-%m-%d')
+    statements = [
+        {"sql": INTRADAY_QUOTES_DDL},
+        {"sql": "INSERT OR IGNORE INTO price_history (symbol, date, price) SELECT symbol, date, price FROM intraday_quotes WHERE date < ? AND symbol NOT LIKE '%=%';", "params": [today_str]},
+        {"sql": "INSERT OR IGNORE INTO exchange_rates (symbol, date, price) SELECT symbol, date, price FROM intraday_quotes WHERE date < ? AND symbol LIKE '%=%';", "params": [today_str]},
+        {"sql": "DELETE FROM intraday_quotes WHERE date < ?;", "params": [today_str]},
+    ]
+    print("\n--- 【盤中報價轉正階段】將過期的盤中報價併入正式歷史數據 ---")
+    if d1_batch(statements, api_key=D1_API_KEY):
+        print("盤中報價轉正完成。")
+    else:
+        print("警告: 盤中報價轉正失敗，將於下次執行時重試。")
+
 def fetch_and_append_market_data(all_symbols, session, batch_size=10):
     if not all_symbols:
         return set(), set() # 回傳空的集合
@@ -189,12 +359,17 @@ def fetch_and_append_market_data(all_symbols, session, batch_size=10):
     print("\n--- 【歷史數據階段】開始為所有標的更新每日歷史收盤價 ---")
     
     placeholders_all = ','.join('?' for _ in all_symbols)
-    all_first_tx_sql = f"SELECT upper(symbol) as symbol, MIN(date) as first_tx_date FROM transactions WHERE upper(symbol) IN ({placeholders_all}) GROUP BY symbol"
-    first_tx_dates_results = d1_query(all_first_tx_sql, [s.upper() for s in all_symbols], api_key=D1_API_KEY)
+    all_first_tx_sql = f"SELECT symbol, MIN(date) as first_tx_date FROM transactions WHERE symbol IN ({placeholders_all}) GROUP BY symbol"
+    first_tx_dates_results = d1_query(all_first_tx_sql, [canonical_symbol(s) for s in all_symbols], api_key=D1_API_KEY)
     first_tx_dates = {row['symbol']: row['first_tx_date'].split('T')[0] for row in first_tx_dates_results if row.get('first_tx_date')}
     
     today_str = datetime.now().strftime('%Y-%m-%d')
     symbol_batches = [all_symbols[i:i + batch_size] for i in range(0, len(all_symbols), batch_size)]
+
+    # 交易中的標的今天的收盤價尚未確定，盤中價格只寫入 intraday_quotes，歷史表只更新到上一個交易日
+    symbols_for_intraday = get_intraday_symbols(all_symbols, session) if session != 'CLOSED' else []
+    in_session_symbols = {canonical_symbol(s) for s in symbols_for_intraday}
+    previous_bday_str = (pd.Timestamp(today_str) - pd.offsets.BDay(1)).strftime('%Y-%m-%d')
     
     # 建立兩個集合，用來追蹤哪些股票和匯率被成功更新
     updated_stock_symbols = set()
@@ -203,11 +378,11 @@ def fetch_and_append_market_data(all_symbols, session, batch_size=10):
     for i, batch in enumerate(symbol_batches):
         print(f"\n--- 正在處理歷史數據批次 {i+1}/{len(symbol_batches)}: {batch} ---")
         
-        upper_batch = [s.upper() for s in batch]
+        upper_batch = [canonical_symbol(s) for s in batch]
         placeholders = ','.join('?' for _ in upper_batch)
-        price_history_sql = f"SELECT upper(symbol) as symbol, MAX(date) as latest_date FROM price_history WHERE upper(symbol) IN ({placeholders}) GROUP BY symbol"
+        price_history_sql = f"SELECT symbol, MAX(date) as latest_date FROM price_history WHERE symbol IN ({placeholders}) GROUP BY symbol"
         price_results = d1_query(price_history_sql, upper_batch, api_key=D1_API_KEY)
-        exchange_rates_sql = f"SELECT upper(symbol) as symbol, MAX(date) as latest_date FROM exchange_rates WHERE upper(symbol) IN ({placeholders}) GROUP BY symbol"
+        exchange_rates_sql = f"SELECT symbol, MAX(date) as latest_date FROM exchange_rates WHERE symbol IN ({placeholders}) GROUP BY symbol"
         fx_results = d1_query(exchange_rates_sql, upper_batch, api_key=D1_API_KEY)
         
         latest_dates = {row['symbol']: row['latest_date'].split('T')[0] for row in (price_results or []) if row.get('latest_date')}
@@ -215,11 +390,12 @@ def fetch_and_append_market_data(all_symbols, session, batch_size=10):
         
         start_dates, symbols_to_fetch = {}, []
         for symbol in batch:
-            symbol_upper = symbol.upper()
+            symbol_upper = canonical_symbol(symbol)
             latest_date_str = latest_dates.get(symbol_upper)
 
             # 只抓取今天之前的歷史數據
-            if not latest_date_str or latest_date_str < today_str:
+            settled_until_str = previous_bday_str if symbol_upper in in_session_symbols else today_str
+            if not latest_date_str or latest_date_str < settled_until_str:
                 start_date = (datetime.strptime(latest_date_str, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d') if latest_date_str else first_tx_dates.get(symbol_upper, "2000-01-01")
                 
                 start_dates[symbol] = start_date
@@ -262,6 +438,7 @@ def fetch_and_append_market_data(all_symbols, session, batch_size=10):
             price_table, dividend_table = ("exchange_rates", None) if is_fx else ("price_history", "dividend_history")
             if symbol_data.empty or 'Close' not in symbol_data.columns or symbol_data['Close'].isnull().all(): continue
             symbol_data = symbol_data.dropna(subset=['Close']); symbol_data = symbol_data[symbol_data.index >= pd.to_datetime(start_dates[symbol_orig])]
+            if symbol in in_session_symbols: symbol_data = symbol_data[symbol_data.index < pd.to_datetime(today_str)]
             if symbol_data.empty: continue
             
             for _, row in symbol_data[['Close']].reset_index().iterrows():
@@ -288,29 +465,13 @@ def fetch_and_append_market_data(all_symbols, session, batch_size=10):
     # ========================= 【核心修改 - 開始】 =========================
     # --- 即時數據處理邏輯 (All-or-Nothing) ---
     if session != 'CLOSED':
-        symbols_for_intraday = []
-        if session == 'TPE':
-            print("\n篩選目標：僅處理台股 (.TW, .TWO) 及匯率相關標的進行盤中更新。")
-            symbols_for_intraday = [s for s in all_symbols if s.upper().endswith(('.TW', '.TWO')) or '=' in s]
-        elif session == 'NYSE':
-            print("\n篩選目標：僅處理非台股的美股及其他國際市場標的進行盤中更新。")
-            symbols_for_intraday = [s for s in all_symbols if not s.upper().endswith(('.TW', '.TWO'))]
-        
         if symbols_for_intraday:
             latest_prices_info = fetch_intraday_prices(symbols_for_intraday)
             
             # 【修改點】檢查是否所有請求的標的都成功獲取了價格
             if latest_prices_info and len(latest_prices_info) == len(symbols_for_intraday):
-                print(f"\n[數據完整] 成功獲取所有 {len(symbols_for_intraday)} 筆盤中價格，準備批次寫入資料庫...")
-                intraday_db_ops = []
-                for symbol, info in latest_prices_info.items():
-                    symbol_upper = symbol.upper()
-                    is_fx = "=" in symbol_upper
-                    table_name = "exchange_rates" if is_fx else "price_history"
-                    sql = f"INSERT INTO {table_name} (symbol, date, price) VALUES (?, ?, ?) ON CONFLICT(symbol, date) DO UPDATE SET price = excluded.price;"
-                    params = [symbol_upper, info['date'], info['price']]
-                    print(f"  [排隊寫入] {symbol_upper} -> {params}")
-                    intraday_db_ops.append({"sql": sql, "params": params})
+                print(f"\n[數據完整] 成功獲取所有 {len(symbols_for_intraday)} 筆盤中價格，準備批次寫入 intraday_quotes...")
+                intraday_db_ops = build_intraday_quote_upserts(latest_prices_info)
                 
                 if intraday_db_ops:
                     if d1_batch(intraday_db_ops, api_key=D1_API_KEY):
@@ -335,6 +496,646 @@ def fetch_and_append_market_data(all_symbols, session, batch_size=10):
         
     return updated_stock_symbols, updated_fx_symbols
 
+# 各交易所以一個參考指數的實際交易日作為預期日曆，避免不同市場的假日互相污染
+MARKET_CALENDAR_REFERENCES = {"NYSE": "^GSPC", "TPE": "^TWII", "HKEX": "^HSI", "JPX": "^N225"}
+MARKET_SUFFIXES = {".TW": "TPE", ".TWO": "TPE", ".HK": "HKEX", ".T": "JPX"}
+INDEX_MARKETS = {"^TWII": "TPE", "^TWOII": "TPE", "^HSI": "HKEX", "^N225": "JPX"}
+GAP_SCAN_MISSES_DDL = "CREATE TABLE IF NOT EXISTS gap_scan_misses (symbol TEXT, date TEXT, checked_at TEXT, PRIMARY KEY(symbol, date));"
+
+def get_symbol_market(symbol):
+    """
+    依代碼判斷標的所屬市場，同市場的標的共用同一份預期交易日曆。
+    已知後綴對應到交易所；^ 開頭的指數依指數對應，其餘指數視為美股；未知後綴自成一個市場 (只與同後綴的標的比對)。
+    """
+    symbol = symbol.upper()
+    if "=" in symbol:
+        return 'FX'
+    if symbol.startswith('^'):
+        return INDEX_MARKETS.get(symbol, 'NYSE')
+    if '.' in symbol:
+        suffix = symbol[symbol.rindex('.'):]
+        return MARKET_SUFFIXES.get(suffix, f"SUFFIX{suffix}")
+    return 'NYSE'
+
+def load_market_calendars(markets, since_date):
+    """
+    下載各市場參考指數自 since_date 起的日線，以其實際交易日作為該市場的預期日曆。
+    沒有參考指數的市場 (匯率、未知後綴) 或下載失敗時不回傳，由 find_missing_date_ranges 退回以已儲存日期的聯集作為日曆。
+    :return: {market: DatetimeIndex}
+    """
+    calendars = {}
+    for market in sorted(markets):
+        reference = MARKET_CALENDAR_REFERENCES.get(market)
+        if not reference:
+            continue
+        def yf_calendar_func():
+            return yf.download(tickers=reference, start=since_date, interval="1d", auto_adjust=False, back_adjust=False, progress=False)
+        data = robust_request(yf_calendar_func, name=f"YFinance Calendar ({reference})")
+        if data is None or data.empty:
+            print(f"警告: 無法取得 {market} 的參考交易日曆 ({reference})，改以已儲存日期的聯集作為日曆。")
+            continue
+        calendars[market] = pd.DatetimeIndex(pd.to_datetime(data.index).tz_localize(None).normalize().unique())
+    return calendars
+
+def load_gap_scan_misses(symbols):
+    """讀取近期已確認抓不到數據的 (symbol, date)，逾 GAP_SCAN_MISS_RETRY_DAYS 天的紀錄會被忽略並重新嘗試"""
+    retry_since = (datetime.now() - timedelta(days=GAP_SCAN_MISS_RETRY_DAYS)).strftime('%Y-%m-%d')
+    frames = []
+    chunk_size = 50
+    for i in range(0, len(symbols), chunk_size):
+        chunk = symbols[i:i + chunk_size]
+        placeholders = ','.join('?' for _ in chunk)
+        rows = d1_query(f"SELECT symbol, date FROM gap_scan_misses WHERE symbol IN ({placeholders}) AND checked_at >= ?", chunk + [retry_since], api_key=D1_API_KEY)
+        if rows:
+            frames.append(pd.DataFrame(rows, columns=['symbol', 'date']))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['symbol', 'date'])
+
+def find_missing_date_ranges(stored_df, calendars=None, known_misses=None):
+    """
+    以向量化方式比對每個標的已儲存的日期與所屬交易所的預期交易日曆，找出序列中間的缺漏區段。
+    預期日曆優先使用 calendars 中該市場參考指數的交易日；沒有時退回同市場所有標的已儲存日期 (僅工作日) 的聯集。
+    known_misses 中的 (symbol, date) 視為已存在，不會再被回報。
+    每個標的只檢查其最早與最晚已儲存日期之間的區間，尾端的增量更新仍由 fetch_and_append_market_data 負責。
+    :param stored_df: 包含 symbol, date 欄位的 DataFrame。
+    :return: {symbol: [(start_date_str, end_date_str), ...]}
+    """
+    if stored_df.empty:
+        return {}
+    calendars = calendars or {}
+
+    # crosstab 依索引對齊欄位，先重設索引以容許呼叫端傳入 concat 後索引重複的 DataFrame
+    stored_df = stored_df.reset_index(drop=True)
+    stored_df = stored_df.assign(date=pd.to_datetime(stored_df['date'].astype(str).str[:10]))
+    stored_df = stored_df[stored_df['date'].dt.dayofweek < 5]
+    stored_df = stored_df.assign(market=stored_df['symbol'].map(get_symbol_market))
+    if known_misses is not None and not known_misses.empty:
+        known_misses = known_misses.reset_index(drop=True).assign(date=pd.to_datetime(known_misses['date'].astype(str).str[:10]))
+
+    missing_ranges = {}
+    for market, market_df in stored_df.groupby('market'):
+        # 列為日期、欄為標的的存在矩陣，一次比對出所有標的的缺漏
+        stored_presence = pd.crosstab(market_df['date'], market_df['symbol']) > 0
+        calendar = calendars.get(market)
+        if calendar is None:
+            calendar = stored_presence.index
+        all_dates = stored_presence.index.union(calendar)
+        stored_presence = stored_presence.reindex(all_dates, fill_value=False)
+        present = stored_presence.to_numpy()
+        # 觀察區間以實際儲存的數據決定，已知抓不到的日期只用來抵銷缺漏
+        first_idx = present.argmax(axis=0)
+        last_idx = len(all_dates) - 1 - present[::-1].argmax(axis=0)
+        if known_misses is not None and not known_misses.empty:
+            market_misses = known_misses[known_misses['symbol'].isin(stored_presence.columns)]
+            if not market_misses.empty:
+                miss_presence = (pd.crosstab(market_misses['date'], market_misses['symbol']) > 0).reindex(index=all_dates, columns=stored_presence.columns, fill_value=False)
+                present = present | miss_presence.to_numpy()
+        expected = all_dates.isin(calendar)[:, None]
+        positions = np.arange(len(all_dates))[:, None]
+        missing = ~present & expected & (positions >= first_idx) & (positions <= last_idx)
+
+        date_strs = all_dates.strftime('%Y-%m-%d').to_numpy()
+        for col in np.flatnonzero(missing.any(axis=0)):
+            # 區段以預期日曆上的位置判斷連續性 (中間只隔非交易日仍視為同一區段)
+            expected_positions = np.flatnonzero(expected[:, 0])
+            idx = np.searchsorted(expected_positions, np.flatnonzero(missing[:, col]))
+            breaks = np.flatnonzero(np.diff(idx) != 1)
+            run_starts = np.concatenate(([idx[0]], idx[breaks + 1]))
+            run_ends = np.concatenate((idx[breaks], [idx[-1]]))
+            missing_ranges[stored_presence.columns[col]] = [(date_strs[expected_positions[s]], date_strs[expected_positions[e]]) for s, e in zip(run_starts, run_ends)]
+
+    return missing_ranges
+
+def expected_gap_dates(symbol, start_date, end_date, calendars, stored_df):
+    """回傳標的所屬市場預期日曆中落在 [start_date, end_date] 的交易日 (沒有參考日曆時以同市場已儲存日期的工作日聯集代替)"""
+    market = get_symbol_market(symbol)
+    calendar = calendars.get(market)
+    if calendar is None:
+        market_dates = pd.to_datetime(stored_df.loc[stored_df['symbol'].map(get_symbol_market) == market, 'date'].astype(str).str[:10])
+        calendar = pd.DatetimeIndex(market_dates[market_dates.dt.dayofweek < 5].unique())
+    window = calendar[(calendar >= pd.to_datetime(start_date)) & (calendar <= pd.to_datetime(end_date))]
+    return sorted(window.strftime('%Y-%m-%d'))
+
+def scan_and_backfill_gaps(all_symbols, batch_size=10):
+    """掃描並只補抓歷史序列中間缺漏的日期區段，回傳已修補的股票與匯率集合"""
+    if not all_symbols:
+        return set(), set()
+
+    print(f"\n--- 【缺口修補階段】開始掃描最近 {GAP_SCAN_LOOKBACK_DAYS} 天內的歷史數據缺口 ---")
+    since_str = (datetime.now() - timedelta(days=GAP_SCAN_LOOKBACK_DAYS)).strftime('%Y-%m-%d')
+    upper_symbols = sorted({canonical_symbol(s) for s in all_symbols})
+
+    # D1 的 SQL 參數數量有限制，需要分批查詢
+    chunk_size = 50
+    frames = []
+    for table in ("price_history", "exchange_rates"):
+        table_symbols = [s for s in upper_symbols if ("=" in s) == (table == "exchange_rates")]
+        for i in range(0, len(table_symbols), chunk_size):
+            chunk = table_symbols[i:i + chunk_size]
+            placeholders = ','.join('?' for _ in chunk)
+            sql = f"SELECT symbol, date FROM {table} WHERE symbol IN ({placeholders}) AND date >= ?"
+            rows = d1_query(sql, chunk + [since_str], api_key=D1_API_KEY)
+            if rows:
+                frames.append(pd.DataFrame(rows, columns=['symbol', 'date']))
+
+    if not frames:
+        print("資料庫中沒有可供掃描的歷史數據。")
+        return set(), set()
+
+    stored_df = pd.concat(frames, ignore_index=True)
+    d1_batch([{"sql": GAP_SCAN_MISSES_DDL}], api_key=D1_API_KEY)
+    markets = {get_symbol_market(s) for s in stored_df['symbol'].unique()}
+    calendars = load_market_calendars(markets, since_str)
+    known_misses = load_gap_scan_misses(upper_symbols)
+    missing_ranges = find_missing_date_ranges(stored_df, calendars, known_misses)
+    if not missing_ranges:
+        print("所有標的的歷史序列皆連續，無需修補。")
+        return set(), set()
+
+    # 相同缺漏區段的標的 (通常來自同一個失敗的批次) 合併為一次下載
+    range_to_symbols = {}
+    for symbol, ranges in missing_ranges.items():
+        print(f"  [缺口] {symbol}: {', '.join(f'{s}~{e}' for s, e in ranges)}")
+        for date_range in ranges:
+            range_to_symbols.setdefault(date_range, []).append(symbol)
+
+    updated_stock_symbols, updated_fx_symbols = set(), set()
+    for (start_date, end_date), symbols in sorted(range_to_symbols.items()):
+        symbol_batches = [symbols[i:i + batch_size] for i in range(0, len(symbols), batch_size)]
+        for batch in symbol_batches:
+            print(f"\n--- 正在補抓 {start_date} ~ {end_date} 的缺口: {batch} ---")
+            end_date_for_fetch = (datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+            def yf_gap_func():
+                return yf.download(tickers=batch, start=start_date, end=end_date_for_fetch, interval="1d", auto_adjust=False, back_adjust=False, progress=False)
+            data = robust_request(yf_gap_func, name="YFinance Gap Download")
+            if data is None:
+                continue
+            # 缺口日期以預期日曆上的交易日為準；下載成功但仍沒有回傳的日期記錄為已知缺漏，避免每次執行重複下載。
+            # yf.download 在限流或網路錯誤時回傳空表而不拋出例外，因此只有成功解析出該標的數據的才會記錄缺漏
+            returned_dates = {symbol: set() for symbol in batch}
+            parsed_symbols = set()
+            db_ops_upsert, symbols_successfully_processed = [], []
+            if not data.empty and isinstance(data.columns, pd.MultiIndex):
+                data.columns = data.columns.set_levels([lvl.upper() for lvl in data.columns.levels[1]], level=1)
+
+            for symbol in batch if not data.empty else []:
+                if isinstance(data.columns, pd.MultiIndex):
+                    try:
+                        symbol_data = data.loc[:, (slice(None), symbol)]; symbol_data.columns = symbol_data.columns.droplevel(1)
+                    except KeyError: continue
+                elif len(batch) == 1: symbol_data = data
+                else: print(f"警告: yfinance 返回了無法識別的單一格式。"); break
+
+                if symbol_data.empty or 'Close' not in symbol_data.columns: continue
+                parsed_symbols.add(symbol)
+                symbol_data = symbol_data.dropna(subset=['Close'])
+                symbol_data = symbol_data[(symbol_data.index >= pd.to_datetime(start_date)) & (symbol_data.index <= pd.to_datetime(end_date))]
+                if symbol_data.empty: continue
+
+                is_fx = "=" in symbol
+                price_table = "exchange_rates" if is_fx else "price_history"
+                for _, row in symbol_data[['Close']].reset_index().iterrows():
+                    returned_dates[symbol].add(row['Date'].strftime('%Y-%m-%d'))
+                    db_ops_upsert.append({"sql": f"INSERT INTO {price_table} (symbol, date, price) VALUES (?, ?, ?) ON CONFLICT(symbol, date) DO UPDATE SET price = excluded.price;", "params": [symbol, row['Date'].strftime('%Y-%m-%d'), row['Close']]})
+                if not is_fx and 'Dividends' in symbol_data.columns and not symbol_data[symbol_data['Dividends'] > 0].empty:
+                    for _, row in symbol_data[symbol_data['Dividends'] > 0][['Dividends']].reset_index().iterrows():
+                        db_ops_upsert.append({"sql": "INSERT INTO dividend_history (symbol, date, dividend) VALUES (?, ?, ?) ON CONFLICT(symbol, date) DO UPDATE SET dividend = excluded.dividend;", "params": [symbol, row['Date'].strftime('%Y-%m-%d'), row['Dividends']]})
+                symbols_successfully_processed.append(symbol)
+
+            checked_at = datetime.now().strftime('%Y-%m-%d')
+            miss_ops = []
+            for symbol in batch:
+                if symbol not in parsed_symbols:
+                    continue
+                expected_dates = [d for d in expected_gap_dates(symbol, start_date, end_date, calendars, stored_df) if d not in returned_dates[symbol]]
+                for date_str in expected_dates:
+                    miss_ops.append({"sql": "INSERT OR REPLACE INTO gap_scan_misses (symbol, date, checked_at) VALUES (?, ?, ?)", "params": [symbol, date_str, checked_at]})
+                if expected_dates:
+                    print(f"  [無數據] {symbol}: {len(expected_dates)} 個交易日在資料源中仍無數據，{GAP_SCAN_MISS_RETRY_DAYS} 天內不再重試。")
+
+            if (db_ops_upsert or miss_ops) and d1_batch(db_ops_upsert + miss_ops, api_key=D1_API_KEY):
+                print(f"成功！ 已補上 {len(db_ops_upsert)} 筆缺漏數據，記錄 {len(miss_ops)} 筆已知缺漏。")
+                for sym in symbols_successfully_processed:
+                    (updated_fx_symbols if "=" in sym else updated_stock_symbols).add(sym)
+
+    return updated_stock_symbols, updated_fx_symbols
+
+CURRENCY_TO_FX = {"USD": "TWD=X", "HKD": "HKDTWD=X", "JPY": "JPYTWD=X"}
+PRICE_HISTORY_TWD_DDL = "CREATE TABLE IF NOT EXISTS price_history_twd (symbol TEXT, date TEXT, currency TEXT, price REAL, fx_rate REAL, price_twd REAL, PRIMARY KEY(symbol, date));"
+
+def find_stale_twd_dates(table, symbols, since_date=None):
+    """
+    以 anti-join 找出 price_history/exchange_rates 中尚未反映到 price_history_twd 的最早日期 (新增或價格變動的列)。
+    :return: {symbol: earliest_stale_date_str}
+    """
+    stale_dates = {}
+    chunk_size = 50
+    date_filter = "AND p.date >= ?" if since_date else ""
+    for i in range(0, len(symbols), chunk_size):
+        chunk = symbols[i:i + chunk_size]
+        placeholders = ','.join('?' for _ in chunk)
+        sql = f"""
+            SELECT p.symbol AS symbol, MIN(p.date) AS since_date
+            FROM {table} p
+            LEFT JOIN price_history_twd t ON t.symbol = p.symbol AND t.date = p.date
+            WHERE p.symbol IN ({placeholders}) {date_filter} AND (t.symbol IS NULL OR t.price != p.price)
+            GROUP BY p.symbol
+        """
+        params = chunk + ([since_date] if since_date else [])
+        for row in d1_query(sql, params, api_key=D1_API_KEY):
+            if row.get('since_date'):
+                stale_dates[row['symbol']] = row['since_date'].split('T')[0]
+    return stale_dates
+
+def empty_series_frame():
+    """空序列也帶正確的欄位型別，避免與非空序列 concat 後日期欄退化為 object 而無法 merge_asof / 對齊日曆"""
+    return pd.DataFrame({'symbol': pd.Series(dtype=object), 'date': pd.Series(dtype='datetime64[ns]'), 'value': pd.Series(dtype=float)})
+
+def load_series(table, symbols, since_date, value_column="price"):
+    """讀取指定標的自 since_date (含) 起的序列，回傳 symbol, date, value 三欄的 DataFrame"""
+    frames = []
+    chunk_size = 50
+    for i in range(0, len(symbols), chunk_size):
+        chunk = symbols[i:i + chunk_size]
+        placeholders = ','.join('?' for _ in chunk)
+        sql = f"SELECT symbol, date, {value_column} AS value FROM {table} WHERE symbol IN ({placeholders}) AND date >= ?"
+        rows = d1_query(sql, chunk + [since_date], api_key=D1_API_KEY)
+        if rows:
+            frames.append(pd.DataFrame(rows, columns=['symbol', 'date', 'value']))
+    if not frames:
+        return empty_series_frame()
+    series_df = pd.concat(frames, ignore_index=True)
+    return series_df.assign(date=pd.to_datetime(series_df['date'].astype(str).str[:10]))
+
+def refresh_price_history_twd(all_symbols, since_date=None):
+    """
+    維護 price_history_twd：每個標的每日的原幣價格、對應匯率與換算後的台幣價格。
+    只重算本次執行中有變動的日期 (個股價格變動影響該標的自身，匯率變動影響同幣別的所有標的)，
+    匯率以 merge_asof 向前填補 (與後端 findFxRate 取不晚於該日最近匯率的行為一致)，找不到匯率時視為 1。
+    :param since_date: 只檢查此日期 (含) 之後的變動；None 代表檢查完整歷史 (週末完整刷新使用)。
+    :return: 本次重算涵蓋的最早日期字串；沒有任何變動或寫入失敗時回傳 None。
+    """
+    if not all_symbols:
+        return
+    print("\n--- 【台幣價格序列階段】開始更新 price_history_twd ---")
+    if not d1_batch([{"sql": PRICE_HISTORY_TWD_DDL}], api_key=D1_API_KEY):
+        print("FATAL: 建立 price_history_twd 失敗，跳過此階段。")
+        return
+
+    symbols = sorted({canonical_symbol(s) for s in all_symbols})
+    stock_symbols = [s for s in symbols if "=" not in s]
+    fx_symbols = sorted(set(CURRENCY_TO_FX.values()))
+
+    # 決定每個標的的計價幣別：以交易紀錄為準，沒有交易紀錄的標的 (如 Benchmark) 依市場推定
+    symbol_currency = {}
+    chunk_size = 50
+    for i in range(0, len(stock_symbols), chunk_size):
+        chunk = stock_symbols[i:i + chunk_size]
+        placeholders = ','.join('?' for _ in chunk)
+        for row in d1_query(f"SELECT symbol, currency FROM transactions WHERE symbol IN ({placeholders}) GROUP BY symbol, currency", chunk, api_key=D1_API_KEY):
+            symbol_currency.setdefault(row['symbol'], row['currency'])
+    for symbol in stock_symbols:
+        symbol_currency.setdefault(symbol, 'TWD' if symbol.endswith(('.TW', '.TWO')) else 'USD')
+
+    stale_stocks = find_stale_twd_dates("price_history", stock_symbols, since_date)
+    stale_fx = find_stale_twd_dates("exchange_rates", fx_symbols, since_date)
+    fx_to_currency = {fx: currency for currency, fx in CURRENCY_TO_FX.items()}
+    stale_currency = {fx_to_currency[fx]: date_str for fx, date_str in stale_fx.items()}
+
+    recompute_since = {}
+    for symbol in stock_symbols:
+        candidates = [d for d in (stale_stocks.get(symbol), stale_currency.get(symbol_currency[symbol])) if d]
+        if candidates:
+            recompute_since[symbol] = min(candidates)
+    if not recompute_since and not stale_fx:
+        print("price_history_twd 已是最新，無需更新。")
+        return
+    changed_since = min(list(recompute_since.values()) + list(stale_fx.values()))
+
+    upsert_sql = "INSERT OR REPLACE INTO price_history_twd (symbol, date, currency, price, fx_rate, price_twd) VALUES (?, ?, ?, ?, ?, ?)"
+    db_ops = []
+
+    # 匯率本身也寫入 price_history_twd，作為下次偵測匯率變動的比對基準
+    for fx_symbol, fx_since in stale_fx.items():
+        fx_rows = load_series("exchange_rates", [fx_symbol], fx_since)
+        for row in fx_rows.itertuples(index=False):
+            db_ops.append({"sql": upsert_sql, "params": [fx_symbol, row.date.strftime('%Y-%m-%d'), 'TWD', float(row.value), 1.0, float(row.value)]})
+
+    currencies = sorted({symbol_currency[s] for s in recompute_since})
+    for currency in currencies:
+        currency_symbols = [s for s in recompute_since if symbol_currency[s] == currency]
+        min_since = min(recompute_since[s] for s in currency_symbols)
+        prices = load_series("price_history", currency_symbols, min_since)
+        if prices.empty:
+            continue
+        since_per_row = pd.to_datetime(prices['symbol'].map(recompute_since))
+        prices = prices[prices['date'] >= since_per_row].sort_values('date')
+
+        fx_symbol = CURRENCY_TO_FX.get(currency)
+        if fx_symbol:
+            # 額外取得起始日前最近的一筆匯率，作為向前填補的種子
+            seed = d1_query("SELECT symbol, date, price AS value FROM exchange_rates WHERE symbol = ? AND date < ? ORDER BY date DESC LIMIT 1", [fx_symbol, min_since], api_key=D1_API_KEY)
+            fx_rows = load_series("exchange_rates", [fx_symbol], min_since)
+            if seed:
+                seed_df = pd.DataFrame(seed, columns=['symbol', 'date', 'value'])
+                fx_rows = pd.concat([seed_df.assign(date=pd.to_datetime(seed_df['date'].astype(str).str[:10])), fx_rows], ignore_index=True)
+            fx_rows = fx_rows[['date', 'value']].rename(columns={'value': 'fx_rate'}).sort_values('date')
+            aligned = pd.merge_asof(prices, fx_rows, on='date', direction='backward')
+            aligned['fx_rate'] = aligned['fx_rate'].fillna(1.0)
+        else:
+            aligned = prices.assign(fx_rate=1.0)
+        aligned['price_twd'] = aligned['value'] * aligned['fx_rate']
+
+        for row in aligned.itertuples(index=False):
+            db_ops.append({"sql": upsert_sql, "params": [row.symbol, row.date.strftime('%Y-%m-%d'), currency, float(row.value), float(row.fx_rate), float(row.price_twd)]})
+
+    print(f"準備寫入 {len(db_ops)} 筆台幣價格序列 (涉及 {len(recompute_since)} 個標的、{len(stale_fx)} 個匯率)...")
+    write_chunk_size = 5000
+    for i in range(0, len(db_ops), write_chunk_size):
+        if not d1_batch(db_ops[i:i + write_chunk_size], api_key=D1_API_KEY):
+            print("FATAL: 寫入 price_history_twd 失敗！將於下次執行時重新偵測並補寫。")
+            return
+    print("成功！ price_history_twd 已更新。")
+    return changed_since
+
+def replay_fifo_lots(pair_txs):
+    """
+    依 FIFO 重播單一 (使用者, 標的) 的交易，規則與後端 getPortfolioStateOnDate 相同 (買入先回補空頭、賣出先沖銷多頭)。
+    數量已預先換算為最新拆股後的單位，因此拆股事件不需另外處理 (成本總額在拆股前後不變)。
+    :return: [(date, 持股數量, 持倉成本TWD)]，每筆交易後的狀態
+    """
+    lots = []
+    steps = []
+    for tx in pair_txs.itertuples(index=False):
+        remaining = tx.adj_quantity
+        per_share = tx.cost_twd / (tx.adj_quantity or 1)
+        if tx.type == 'buy':
+            while remaining > 0 and lots and lots[0][0] < 0:
+                covered = min(remaining, -lots[0][0])
+                lots[0][0] += covered
+                remaining -= covered
+                if abs(lots[0][0]) < 1e-9: lots.pop(0)
+            if remaining > 1e-9: lots.append([remaining, per_share])
+        else:
+            while remaining > 0 and lots and lots[0][0] > 0:
+                sold = min(remaining, lots[0][0])
+                lots[0][0] -= sold
+                remaining -= sold
+                if lots[0][0] < 1e-9: lots.pop(0)
+            if remaining > 1e-9: lots.append([-remaining, per_share])
+        steps.append((tx.date, sum(q for q, _ in lots), sum(q * p for q, p in lots)))
+    return steps
+
+def align_step_matrix(steps_df, value_column, dates):
+    """將 (date, pair, value) 的階梯序列轉為 dates × pairs 矩陣：同日取最後一筆，之後向前填補，首筆交易前為 0"""
+    matrix = steps_df.groupby(['date', 'pair'])[value_column].last().unstack('pair')
+    return matrix.reindex(matrix.index.union(dates)).ffill().reindex(dates).fillna(0.0)
+
+def load_latest_before(table, symbols, before_date):
+    """取得各標的在 before_date 之前的最後一筆值，作為向前填補的種子"""
+    frames = []
+    chunk_size = 50
+    for i in range(0, len(symbols), chunk_size):
+        chunk = symbols[i:i + chunk_size]
+        placeholders = ','.join('?' for _ in chunk)
+        sql = f"SELECT symbol, MAX(date) AS date, price AS value FROM {table} WHERE symbol IN ({placeholders}) AND date < ? GROUP BY symbol"
+        rows = d1_query(sql, chunk + [before_date], api_key=D1_API_KEY)
+        if rows:
+            frames.append(pd.DataFrame(rows, columns=['symbol', 'date', 'value']))
+    if not frames:
+        return empty_series_frame()
+    seed_df = pd.concat(frames, ignore_index=True)
+    return seed_df.assign(date=pd.to_datetime(seed_df['date'].astype(str).str[:10]))
+
+def load_daily_matrix(table, symbols, since_date, dates):
+    """讀取序列並展開成 dates × symbols 的日曆矩陣 (含起始日前的種子，向前填補，與後端 findNearest 一致)"""
+    series_df = pd.concat([load_latest_before(table, symbols, since_date), load_series(table, symbols, since_date)], ignore_index=True)
+    if series_df.empty:
+        return pd.DataFrame(np.nan, index=dates, columns=symbols)
+    matrix = series_df.pivot_table(index='date', columns='symbol', values='value', aggfunc='last')
+    matrix = matrix.reindex(matrix.index.union(dates)).ffill()
+    return matrix.reindex(index=dates, columns=symbols)
+
+def run_batch_valuation_snapshots(changed_since):
+    """
+    批次估值階段：一次載入所有使用者的交易與最新價格，以矩陣運算算出每位使用者在變動日期的持倉市值與成本，
+    再批次寫回 portfolio_summary.history 與 portfolio_snapshots (group_id = 'all')。
+    後端重算會以最新快照為基準，只需補算快照之後的日期，免去逐日重播。
+    只處理已收盤定案的日期 (今天的價格仍在 intraday_quotes 盤中覆蓋層，交由後端計算)。
+    """
+    print("\n--- 【批次估值快照階段】開始 ---")
+    last_settled_date = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    if not changed_since or changed_since > last_settled_date:
+        print("沒有已定案日期的價格變動，跳過批次估值。")
+        return
+
+    # 只處理後端歷史已連續算到變動起始日前一天的使用者；其餘 (新使用者、久未重算) 交由後端補算，避免以新快照為基準而漏算中間日期
+    window_start_floor = (pd.to_datetime(changed_since) - timedelta(days=1)).strftime('%Y-%m-%d')
+    snapshot_rows = d1_query("""
+        SELECT s.uid AS uid, MAX(s.snapshot_date) AS latest_snapshot
+        FROM portfolio_snapshots s JOIN portfolio_summary p ON p.uid = s.uid AND p.group_id = 'all'
+        WHERE s.group_id = 'all' GROUP BY s.uid
+    """, api_key=D1_API_KEY)
+    eligible_uids = {row['uid'] for row in snapshot_rows if str(row.get('latest_snapshot') or '')[:10] >= window_start_floor}
+    tx_rows = d1_query("SELECT uid, symbol, date, type, quantity, price, currency, totalCost FROM transactions ORDER BY date ASC", api_key=D1_API_KEY)
+    txs = pd.DataFrame([r for r in tx_rows if r['uid'] in eligible_uids], columns=['uid', 'symbol', 'date', 'type', 'quantity', 'price', 'currency', 'totalCost'])
+    if txs.empty:
+        print("沒有需要估值的使用者。")
+        return
+
+    txs['symbol'] = txs['symbol'].map(canonical_symbol)
+    txs['date'] = pd.to_datetime(txs['date'].astype(str).str[:10])
+    txs = txs[txs['date'] <= pd.to_datetime(last_settled_date)].sort_values('date', kind='stable').reset_index(drop=True)
+    txs['quantity'] = pd.to_numeric(txs['quantity'], errors='coerce').fillna(0.0)
+    txs['currency'] = txs['currency'].fillna('USD')
+    price_total = pd.to_numeric(txs['price'], errors='coerce').fillna(0.0) * txs['quantity']
+    txs['total_cost'] = pd.to_numeric(txs['totalCost'], errors='coerce').fillna(price_total)
+
+    # 拆股：將每筆交易數量換算為拆股後單位 (同日或之後的拆股皆適用，與後端事件排序一致)
+    txs['adj_quantity'] = txs['quantity']
+    split_rows = d1_query("SELECT uid, symbol, date, ratio FROM splits", api_key=D1_API_KEY)
+    if split_rows:
+        splits = pd.DataFrame(split_rows, columns=['uid', 'symbol', 'date', 'ratio'])
+        splits['symbol'] = splits['symbol'].map(canonical_symbol)
+        splits['date'] = pd.to_datetime(splits['date'].astype(str).str[:10])
+        matched = txs[['uid', 'symbol', 'date']].reset_index().merge(splits, on=['uid', 'symbol'], suffixes=('', '_split'))
+        factors = matched[matched['date_split'] >= matched['date']].groupby('index')['ratio'].prod()
+        txs.loc[factors.index, 'adj_quantity'] = txs.loc[factors.index, 'quantity'] * factors.astype(float)
+
+    dates = pd.date_range(changed_since, last_settled_date, freq='D')
+    earliest_tx_date = txs['date'].min().strftime('%Y-%m-%d')
+    fx_symbols = sorted(set(CURRENCY_TO_FX.values()))
+    fx_series = pd.concat([load_latest_before("exchange_rates", fx_symbols, earliest_tx_date), load_series("exchange_rates", fx_symbols, earliest_tx_date)], ignore_index=True)
+
+    # 交易成本換算台幣：匯率以交易日 (含) 前最近一筆為準，找不到時視為 1
+    txs['fx_symbol'] = txs['currency'].map(CURRENCY_TO_FX)
+    txs['tx_fx'] = 1.0
+    for fx_symbol, idx in txs.groupby('fx_symbol').groups.items():
+        rates = fx_series[fx_series['symbol'] == fx_symbol][['date', 'value']].sort_values('date')
+        if rates.empty: continue
+        rates = rates.astype({'date': txs['date'].dtype, 'value': float})
+        aligned = pd.merge_asof(txs.loc[idx, ['date']].reset_index().sort_values('date'), rates, on='date', direction='backward').set_index('index')
+        txs.loc[aligned.index, 'tx_fx'] = aligned['value'].fillna(1.0)
+    txs['cost_twd'] = txs['total_cost'] * txs['tx_fx']
+
+    # 成本與持股數量：FIFO 只需逐筆重播交易 (筆數遠少於使用者 × 日期)，之後展開為矩陣
+    txs['pair'] = txs['uid'] + '|' + txs['symbol']
+    steps = []
+    for pair, pair_txs in txs.groupby('pair', sort=False):
+        steps.extend((d, pair, q, c) for d, q, c in replay_fifo_lots(pair_txs))
+    steps_df = pd.DataFrame(steps, columns=['date', 'pair', 'quantity', 'cost'])
+    quantity_matrix = align_step_matrix(steps_df, 'quantity', dates)
+    cost_matrix = align_step_matrix(steps_df, 'cost', dates).reindex(columns=quantity_matrix.columns)
+
+    pairs = quantity_matrix.columns
+    pair_info = txs.groupby('pair')[['uid', 'symbol', 'currency']].last().reindex(pairs)
+    symbols = sorted(pair_info['symbol'].unique())
+    price_matrix = load_daily_matrix("price_history", symbols, changed_since, dates)
+    fx_matrix = load_daily_matrix("exchange_rates", fx_symbols, changed_since, dates)
+    fx_matrix['TWD'] = 1.0
+    pair_fx_columns = [CURRENCY_TO_FX.get(c, 'TWD') if c != 'TWD' else 'TWD' for c in pair_info['currency']]
+
+    # 核心矩陣運算：市值 = 持股 × 價格 × 匯率 (dates × pairs)，再依使用者加總
+    quantities = quantity_matrix.to_numpy()
+    prices = price_matrix[pair_info['symbol']].to_numpy()
+    fx_rates = np.nan_to_num(fx_matrix[pair_fx_columns].to_numpy(), nan=1.0)
+    held = np.abs(quantities) >= 1e-9
+    market_values = np.where(held & ~np.isnan(prices), quantities * np.nan_to_num(prices) * fx_rates, 0.0)
+    value_by_uid = pd.DataFrame(market_values, index=dates, columns=pair_info['uid']).T.groupby(level=0).sum()
+    cost_by_uid = pd.DataFrame(cost_matrix.to_numpy(), index=dates, columns=pair_info['uid']).T.groupby(level=0).sum()
+
+    first_tx_dates = txs.groupby('uid')['date'].min()
+    history_sql_prefix = "UPDATE portfolio_summary SET history = json_set(COALESCE(history, '{}')"
+    snapshot_sql = "INSERT OR REPLACE INTO portfolio_snapshots (uid, group_id, snapshot_date, market_value_twd, total_cost_twd) VALUES (?, 'all', ?, ?, ?)"
+    db_ops = []
+    # D1 單一語句的參數上限為 100，每個日期佔 2 個參數
+    dates_per_statement = 45
+    for uid, values in value_by_uid.iterrows():
+        values = values[values.index >= first_tx_dates[uid]]
+        if values.empty: continue
+        items = [(d.strftime('%Y-%m-%d'), float(v)) for d, v in values.items()]
+        for i in range(0, len(items), dates_per_statement):
+            chunk = items[i:i + dates_per_statement]
+            params = [p for date_str, value in chunk for p in (f'$."{date_str}"', value)]
+            db_ops.append({"sql": f"{history_sql_prefix}{', ?, ?' * len(chunk)}) WHERE uid = ? AND group_id = 'all'", "params": params + [uid]})
+        db_ops.append({"sql": snapshot_sql, "params": [uid, last_settled_date, float(values.iloc[-1]), float(cost_by_uid.loc[uid, values.index[-1]])]})
+
+    print(f"已完成 {len(value_by_uid)} 位使用者 × {len(dates)} 個日期的矩陣估值，準備寫入 {len(db_ops)} 筆語句...")
+    write_chunk_size = 5000
+    for i in range(0, len(db_ops), write_chunk_size):
+        if not d1_batch(db_ops[i:i + write_chunk_size], api_key=D1_API_KEY):
+            print("FATAL: 批次估值快照寫入失敗！後端重算將以既有快照為基準完整補算。")
+            return
+    print(f"成功！已為 {len(value_by_uid)} 位使用者寫入 {last_settled_date} 的估值快照。")
+
+# ========================= 【市場數據快照檔 - 開始】 =========================
+# == 新增：在成功執行後輸出欄式 .npz 快照 (價格、匯率、股利)，symbol 欄以字典編碼 (symbols 陣列 + int32 代碼)，
+# == 每日執行只增量補上變動日期之後的資料，週末完整刷新後則整份重建；讀取端只需一次 np.load 即可取得完整歷史
+# =========================================================================================
+MARKET_SNAPSHOT_FORMAT_VERSION = 1
+MARKET_SNAPSHOT_SERIES = {
+    "prices": ("price_history", "price"),
+    "fx": ("exchange_rates", "price"),
+    "dividends": ("dividend_history", "dividend"),
+}
+
+def fetch_table_rows(table, value_column, since_date=None, page_size=10000):
+    """以 (symbol, date) 鍵集分頁讀出整張表 (可限定 since_date 之後)，避免單次 /query 回應過大"""
+    frames = []
+    last_key = None
+    date_filter = "AND date >= ?" if since_date else ""
+    while True:
+        key_filter = "AND (symbol, date) > (?, ?)" if last_key else ""
+        sql = f"SELECT symbol, date, {value_column} AS value FROM {table} WHERE 1 = 1 {date_filter} {key_filter} ORDER BY symbol, date LIMIT {page_size}"
+        params = ([since_date] if since_date else []) + (list(last_key) if last_key else [])
+        rows = d1_query(sql, params, api_key=D1_API_KEY)
+        if rows:
+            frames.append(pd.DataFrame(rows, columns=['symbol', 'date', 'value']))
+        if len(rows) < page_size:
+            break
+        last_key = (rows[-1]['symbol'], rows[-1]['date'])
+    if not frames:
+        return pd.DataFrame(columns=['symbol', 'date', 'value'])
+    table_df = pd.concat(frames, ignore_index=True)
+    return table_df.assign(date=pd.to_datetime(table_df['date'].astype(str).str[:10]))
+
+def load_market_snapshot(path):
+    """讀取既有快照；檔案不存在或格式版本不符時回傳 None (改為整份重建)"""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            snapshot = {key: data[key] for key in data.files}
+    except (OSError, ValueError) as e:
+        print(f"警告: 無法讀取既有快照 {path}: {e}")
+        return None
+    if int(snapshot.get('format_version', -1)) != MARKET_SNAPSHOT_FORMAT_VERSION:
+        print(f"既有快照格式版本不符 (預期 v{MARKET_SNAPSHOT_FORMAT_VERSION})，將整份重建。")
+        return None
+    return snapshot
+
+def export_market_snapshot(path, since_date=None, full_rebuild=False, overlap_days=7):
+    """
+    輸出市場數據快照 (.npz)。
+    增量模式下，每個序列從「本次變動的最早日期」與「既有快照最後日期往前 overlap_days 天」兩者較早者開始重新讀取並取代，
+    其餘列沿用既有快照；symbol 字典只在尾端追加新代碼，既有代碼保持不變。
+    :param since_date: 本次執行中有變動的最早日期 (例如 refresh_price_history_twd 的回傳值)
+    :param full_rebuild: 為 True 時忽略既有快照，重新讀出所有資料 (週末完整刷新後使用)
+    """
+    if not path:
+        return False
+    print(f"\n--- 【市場數據快照階段】開始輸出 {path} ---")
+    previous = load_market_snapshot(path)
+    existing = None if full_rebuild else previous
+    symbols = list(existing['symbols']) if existing is not None else []
+    symbol_codes = {symbol: code for code, symbol in enumerate(symbols)}
+    arrays = {}
+
+    for kind, (table, value_column) in MARKET_SNAPSHOT_SERIES.items():
+        cutoff = None
+        if existing is not None and len(existing[f'{kind}_date']) > 0:
+            cutoff = (pd.Timestamp(existing[f'{kind}_date'].max()) - timedelta(days=overlap_days)).strftime('%Y-%m-%d')
+            if since_date and since_date < cutoff:
+                cutoff = since_date
+        fresh = fetch_table_rows(table, value_column, since_date=cutoff)
+
+        for symbol in fresh['symbol'].unique():
+            if symbol not in symbol_codes:
+                symbol_codes[symbol] = len(symbols)
+                symbols.append(symbol)
+        codes = fresh['symbol'].map(symbol_codes).to_numpy(dtype=np.int32)
+        dates = fresh['date'].to_numpy(dtype='datetime64[D]')
+        values = fresh['value'].to_numpy(dtype=np.float64)
+
+        if cutoff is not None:
+            keep = existing[f'{kind}_date'] < np.datetime64(cutoff, 'D')
+            codes = np.concatenate([existing[f'{kind}_symbol'][keep], codes])
+            dates = np.concatenate([existing[f'{kind}_date'][keep], dates])
+            values = np.concatenate([existing[f'{kind}_value'][keep], values])
+
+        order = np.lexsort((dates, codes))
+        arrays[f'{kind}_symbol'] = codes[order]
+        arrays[f'{kind}_date'] = dates[order]
+        arrays[f'{kind}_value'] = values[order]
+        mode = "整份" if cutoff is None else f"自 {cutoff} 起增量"
+        print(f"{kind}: {mode}讀取 {len(fresh)} 筆，快照共 {len(codes)} 筆。")
+
+    # snapshot_version 在整份重建時也持續遞增，讀取端可據此判斷快照是否已更新
+    snapshot_version = int(previous['snapshot_version']) + 1 if previous is not None else 1
+    arrays.update({
+        'format_version': np.array(MARKET_SNAPSHOT_FORMAT_VERSION, dtype=np.int32),
+        'snapshot_version': np.array(snapshot_version, dtype=np.int64),
+        'generated_at': np.array(datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')),
+        'symbols': np.array(symbols, dtype=str),
+    })
+    # 先寫入暫存檔再原子性替換，讀取端不會讀到寫到一半的檔案
+    tmp_path = f"{path}.tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+    print(f"成功！已輸出快照 v{snapshot_version} ({len(symbols)} 個標的)。")
+    return True
+
+# ========================= 【市場數據快照檔 - 結束】 =========================
+
 def invalidate_caches_precisely(updated_stocks, updated_fx):
     """根據更新的股票和匯率，精準地將相關的群組標記為 dirty"""
     if not updated_stocks and not updated_fx:
@@ -422,24 +1223,142 @@ def trigger_recalculations(uids):
     else: print("觸發全部重算最終失敗。")
 
 
-if __name__ == "__main__":
-    print(f"--- 開始執行每日市場數據增量更新腳本 (v7.1 - Atomic Intraday Update) --- {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    session = get_current_market_session()
-    print(f"偵測到當前市場時段: {session}")
+def flush_intraday_changes(pending_stocks, pending_fx, uids):
+    """將常駐輪詢期間累積的價格變動，一次性進行快取失效與重算觸發"""
+    if not pending_stocks and not pending_fx:
+        return
+    invalidate_caches_precisely(pending_stocks, pending_fx)
+    if uids:
+        trigger_recalculations(uids)
+    pending_stocks.clear()
+    pending_fx.clear()
+
+def run_intraday_polling_service(exit_when_closed=False):
+    """
+    常駐盤中輪詢模式：在 TPE 與 NYSE 交易時段內持續運行。
+    標的列表、intraday_quotes 中的最新報價皆保留在記憶體中，每個輪詢週期只做一次報價抓取與一次僅含變動價格的小批次寫入；
+    標的列表的增量刷新、快取失效與重算觸發則以較慢的節奏 (INTRADAY_TARGET_REFRESH_SECONDS) 進行。
+    :param exit_when_closed: 市場休市時是否直接結束服務 (否則進入待機並定期重新檢查時段)。
+    """
+    print(f"\n--- 【常駐盤中輪詢模式】啟動：輪詢間隔 {INTRADAY_POLL_INTERVAL_SECONDS} 秒，目標列表刷新間隔 {INTRADAY_TARGET_REFRESH_SECONDS} 秒 ---")
     all_symbols, all_uids = get_update_targets()
-    
-    if all_symbols:
-        print(f"將為所有 {len(all_symbols)} 個標的檢查歷史數據並更新: {all_symbols}")
-        # 【修改】接收回傳的已更新標的
-        updated_stocks, updated_fx = fetch_and_append_market_data(all_symbols, session)
+    latest_stored = load_intraday_quotes()
+    last_refresh = time_sleep.monotonic()
+    pending_stocks, pending_fx = set(), set()
+
+    try:
+        while True:
+            if time_sleep.monotonic() - last_refresh >= INTRADAY_TARGET_REFRESH_SECONDS:
+                flush_intraday_changes(pending_stocks, pending_fx, all_uids)
+                refreshed_symbols, all_uids = get_update_targets()
+                known_symbols = {canonical_symbol(s) for s in all_symbols}
+                new_symbols = [s for s in refreshed_symbols if canonical_symbol(s) not in known_symbols]
+                if new_symbols:
+                    print(f"偵測到 {len(new_symbols)} 個新標的: {new_symbols}")
+                all_symbols = refreshed_symbols
+                last_refresh = time_sleep.monotonic()
+
+            session = get_current_market_session()
+            if session == 'CLOSED':
+                flush_intraday_changes(pending_stocks, pending_fx, all_uids)
+                if exit_when_closed:
+                    print("\n市場已休市，常駐盤中輪詢服務結束。")
+                    break
+                time_sleep.sleep(INTRADAY_TARGET_REFRESH_SECONDS)
+                continue
+
+            symbols_for_intraday = get_intraday_symbols(all_symbols, session)
+            latest_prices_info = fetch_intraday_prices(symbols_for_intraday) if symbols_for_intraday else {}
+
+            if latest_prices_info and len(latest_prices_info) == len(symbols_for_intraday):
+                changed_prices = {
+                    symbol: info for symbol, info in latest_prices_info.items()
+                    if symbol not in latest_stored
+                    or latest_stored[symbol]['date'] != info['date']
+                    or abs(float(latest_stored[symbol]['price']) - float(info['price'])) > 1e-9
+                }
+                if changed_prices:
+                    intraday_db_ops = build_intraday_quote_upserts(changed_prices)
+                    if d1_batch(intraday_db_ops, api_key=D1_API_KEY):
+                        print(f"成功寫入 {len(changed_prices)} 筆有變動的盤中價格。")
+                        for symbol, info in changed_prices.items():
+                            latest_stored[symbol] = {"price": float(info['price']), "date": info['date']}
+                            (pending_fx if "=" in symbol else pending_stocks).add(symbol)
+                    else:
+                        print("FATAL: 資料庫批次寫入請求失敗！(常駐盤中輪詢)")
+                else:
+                    print("本次輪詢所有價格皆無變動，跳過寫入。")
+            elif latest_prices_info:
+                print(f"\n[數據不完整] 警告: 盤中價格獲取不完整 (預期 {len(symbols_for_intraday)}, 實際 {len(latest_prices_info)})。本次輪詢跳過寫入。")
+
+            time_sleep.sleep(INTRADAY_POLL_INTERVAL_SECONDS)
+    except KeyboardInterrupt:
+        print("\n收到中斷訊號，正在結束常駐盤中輪詢服務...")
+        flush_intraday_changes(pending_stocks, pending_fx, all_uids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="每日市場數據增量更新腳本")
+    parser.add_argument("--daemon", action="store_true", help="以常駐服務模式在交易時段內持續輪詢盤中價格")
+    parser.add_argument("--exit-when-closed", action="store_true", help="常駐模式下，市場休市時直接結束服務")
+    args = parser.parse_args()
+    lease_holder = default_lease_holder()
+    if args.daemon:
+        # 常駐模式只寫入 intraday_quotes 覆蓋層，不與每日/週末更新衝突，只需避免同時有兩個常駐服務
+        if not acquire_run_lease(INTRADAY_DAEMON_LEASE, lease_holder):
+            print("已有其他常駐盤中輪詢服務正在執行，本次啟動直接結束。")
+            raise SystemExit(0)
+        heartbeat = start_lease_heartbeat(INTRADAY_DAEMON_LEASE, lease_holder)
+        try:
+            run_intraday_polling_service(exit_when_closed=args.exit_when_closed)
+        finally:
+            heartbeat.set()
+            release_run_lease(INTRADAY_DAEMON_LEASE, lease_holder)
+        raise SystemExit(0)
+
+    print(f"--- 開始執行每日市場數據增量更新腳本 (v7.9 - Market Data Snapshot File) --- {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    # 先取得自己的租約再檢查週末租約 (週末腳本則是先取得租約再等待每日租約釋放)，兩者不會同時通過檢查
+    if not acquire_run_lease(DAILY_LEASE, lease_holder):
+        # 持有者是較早啟動、仍在心跳中的另一個每日執行 (或 run_leases 暫時無法存取)
+        active_lease = get_active_lease(DAILY_LEASE)
+        active_holder = active_lease.get('holder') if active_lease else '未知'
+        print(f"另一個每日更新執行 ({active_holder}) 仍持有租約 {DAILY_LEASE}，本次執行直接結束，交由該執行完成。")
+        raise SystemExit(0)
+    weekend_lease = get_active_lease(WEEKEND_LEASE)
+    if weekend_lease:
+        print(f"週末完整刷新 ({weekend_lease.get('holder')}) 正在進行，本次每日更新直接結束，交由週末刷新處理。")
+        release_run_lease(DAILY_LEASE, lease_holder)
+        raise SystemExit(0)
+    heartbeat = start_lease_heartbeat(DAILY_LEASE, lease_holder)
+
+    try:
+        session = get_current_market_session()
+        print(f"偵測到當前市場時段: {session}")
+        all_symbols, all_uids = get_update_targets()
         
-        # 只有在真的有數據更新時，才觸發後續操作
-        if updated_stocks or updated_fx:
-            invalidate_caches_precisely(updated_stocks, updated_fx)
-            if all_uids: 
-                trigger_recalculations(all_uids)
+        if all_symbols:
+            print(f"將為所有 {len(all_symbols)} 個標的檢查歷史數據並更新: {all_symbols}")
+            # 【修改】接收回傳的已更新標的
+            updated_stocks, updated_fx = fetch_and_append_market_data(all_symbols, session)
+            promote_intraday_quotes()
+            gap_stocks, gap_fx = scan_and_backfill_gaps(all_symbols)
+            updated_stocks |= gap_stocks
+            updated_fx |= gap_fx
+            changed_since = refresh_price_history_twd(all_symbols, since_date=(datetime.now() - timedelta(days=GAP_SCAN_LOOKBACK_DAYS)).strftime('%Y-%m-%d'))
+            run_batch_valuation_snapshots(changed_since)
+            if MARKET_SNAPSHOT_PATH:
+                export_market_snapshot(MARKET_SNAPSHOT_PATH, since_date=changed_since)
+            
+            # 只有在真的有數據更新時，才觸發後續操作
+            if updated_stocks or updated_fx:
+                invalidate_caches_precisely(updated_stocks, updated_fx)
+                if all_uids: 
+                    trigger_recalculations(all_uids)
+            else:
+                print("\n本次執行未更新任何市場價格數據，無需觸發重算。")
         else:
-            print("\n本次執行未更新任何市場價格數據，無需觸發重算。")
-    else:
-        print("資料庫中沒有找到任何需要處理的標的。")
+            print("資料庫中沒有找到任何需要處理的標的。")
+    finally:
+        heartbeat.set()
+        release_run_lease(DAILY_LEASE, lease_holder)
     print(f"--- 每日市場數據增量更新腳本執行完畢 --- {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
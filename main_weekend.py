@@ -1,19 +1,27 @@
 # =========================================================================================
-# == Python 週末完整校驗腳本 (v3.6 - Adaptive Data Parsing)
+# == Python 週末完整校驗腳本 (v3.12 - Market Data Snapshot File)
 # =========================================================================================
 import os
+import argparse
+import zlib
 import yfinance as yf
 import requests
 import json
 from datetime import datetime, timedelta
 import time
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+# 台幣價格序列的增量計算邏輯與執行租約皆與每日腳本共用
+from main import refresh_price_history_twd, PRICE_HISTORY_TWD_DDL, export_market_snapshot, MARKET_SNAPSHOT_PATH
+from main import DAILY_LEASE, WEEKEND_LEASE, PREWARM_LEASE, acquire_run_lease, start_lease_heartbeat, release_run_lease, wait_for_lease_drain
 
 # --- 從環境變數讀取設定 ---
 D1_WORKER_URL = os.environ.get("D1_WORKER_URL")
 D1_API_KEY = os.environ.get("D1_API_KEY")
 GCP_API_URL = os.environ.get("GCP_API_URL")
 GCP_API_KEY = D1_API_KEY
+# 市場宇宙預熱 (--prewarm) 的歷史數據回溯年數
+PREWARM_HORIZON_YEARS = int(os.environ.get("PREWARM_HORIZON_YEARS", "10"))
 
 # ========================= 【核心優化 A - 開始】 =========================
 # == 新增：穩健的請求函式，包含錯誤處理與自動重試機制
@@ -66,6 +74,11 @@ def d1_batch(statements):
     return success if success is not None else False
 
 
+def canonical_symbol(symbol):
+    """將股票代碼正規化為資料庫中的標準形式 (去除空白並轉為大寫)，與 main.py 及後端 API 的寫入路徑一致"""
+    return symbol.strip().upper() if symbol else symbol
+
+
 def get_full_refresh_targets():
     """全面獲取更新目標，並包含全局最早的交易日期"""
     print("正在全面獲取所有需要完整刷新的金融商品列表...")
@@ -78,7 +91,7 @@ def get_full_refresh_targets():
     tx_symbols_results = d1_query(transactions_sql)
     if tx_symbols_results:
         for row in tx_symbols_results:
-            all_symbols.add(row['symbol'])
+            all_symbols.add(canonical_symbol(row['symbol']))
 
     currencies_sql = "SELECT DISTINCT currency FROM transactions"
     currencies_results = d1_query(currencies_sql)
@@ -92,7 +105,7 @@ def get_full_refresh_targets():
     benchmark_results = d1_query(benchmark_sql)
     if benchmark_results:
         for row in benchmark_results:
-            symbol = row['symbol']
+            symbol = canonical_symbol(row['symbol'])
             if symbol:
                 all_symbols.add(symbol)
                 benchmark_symbols.add(symbol)
@@ -120,25 +133,9 @@ def get_full_refresh_targets():
 # ========================= 【核心優化 B - 開始】 =========================
 # == 修改：採用「原子性替換」策略，確保數據庫更新的穩定性
 # =========================================================================================
-def fetch_and_overwrite_market_data(targets, benchmark_symbols, global_earliest_tx_date):
-    if not targets:
-        print("沒有需要刷新的標的。")
-        return False # 【修正】回傳狀態
-
-    print("步驟 1/5: 正在一次性查詢所有股票的交易狀態...")
-    all_symbols_info_sql = """
-        SELECT
-            symbol,
-            MIN(date) as earliest_date,
-            MAX(date) as last_tx_date,
-            SUM(CASE WHEN type = 'buy' THEN quantity ELSE -quantity END) as net_quantity
-        FROM transactions
-        GROUP BY symbol
-    """
-    all_symbols_info = {row['symbol']: row for row in d1_query(all_symbols_info_sql)}
-    print("查詢完成。")
-
-    print("\n步驟 2/5: 正在初始化臨時數據表...")
+def prepare_temp_tables():
+    """清除殘留的舊表與臨時表，並建立本次刷新要寫入的臨時表 (所有分片共用)"""
+    print("\n步驟 1/5: 正在初始化臨時數據表...")
     # Cloudflare D1 不支援 `CREATE TABLE LIKE`，所以我們手動定義結構
     # 同時，先清除上一次可能遺留的舊表和臨時表，確保一個乾淨的開始
     init_statements = [
@@ -151,11 +148,28 @@ def fetch_and_overwrite_market_data(targets, benchmark_symbols, global_earliest_
         {"sql": "CREATE TABLE price_history_temp (symbol TEXT, date TEXT, price REAL, PRIMARY KEY(symbol, date));"},
         {"sql": "CREATE TABLE dividend_history_temp (symbol TEXT, date TEXT, dividend REAL, PRIMARY KEY(symbol, date));"},
         {"sql": "CREATE TABLE exchange_rates_temp (symbol TEXT, date TEXT, price REAL, PRIMARY KEY(symbol, date));"},
+        {"sql": "CREATE TABLE IF NOT EXISTS prewarm_universe (symbol TEXT PRIMARY KEY, added_at TEXT);"},
     ]
     if not d1_batch(init_statements):
         print("FATAL: 初始化臨時數據表失敗，腳本終止。")
         return False # 【修正】回傳狀態
     print("臨時表初始化成功。")
+    return True
+
+def fetch_into_temp_tables(targets, benchmark_symbols, global_earliest_tx_date):
+    """抓取指定標的的價格與股利並寫入臨時表；分片模式下每個分片只處理自己的標的"""
+    print("\n步驟 2/5: 正在一次性查詢所有股票的交易狀態...")
+    all_symbols_info_sql = """
+        SELECT
+            symbol,
+            MIN(date) as earliest_date,
+            MAX(date) as last_tx_date,
+            SUM(CASE WHEN type = 'buy' THEN quantity ELSE -quantity END) as net_quantity
+        FROM transactions
+        GROUP BY symbol
+    """
+    all_symbols_info = {canonical_symbol(row['symbol']): row for row in d1_query(all_symbols_info_sql)}
+    print("查詢完成。")
 
 
     print("\n步驟 3/5: 開始逐一獨立抓取 **價格** 數據並寫入臨時表...")
@@ -250,7 +264,7 @@ def fetch_and_overwrite_market_data(targets, benchmark_symbols, global_earliest_
         
         price_rows = symbol_data[['Close']].reset_index()
         for _, row in price_rows.iterrows():
-            all_price_db_ops.append({ "sql": f"INSERT INTO {price_table} (symbol, date, price) VALUES (?, ?, ?)", "params": [symbol, row['Date'].strftime('%Y-%m-%d'), row['Close']]})
+            all_price_db_ops.append({ "sql": f"INSERT OR REPLACE INTO {price_table} (symbol, date, price) VALUES (?, ?, ?)", "params": [symbol, row['Date'].strftime('%Y-%m-%d'), row['Close']]})
         
         all_symbols_successfully_processed.append(symbol)
 
@@ -295,7 +309,7 @@ def fetch_and_overwrite_market_data(targets, benchmark_symbols, global_earliest_
                     print(f"  -> [成功] 找到 {symbol} 在交易期間內 ({start_date} to {end_date}) 的 {len(dividend_rows)} 筆配息紀錄。")
                     for _, row in dividend_rows.iterrows():
                         dividend_ops_to_temp.append({
-                            "sql": "INSERT INTO dividend_history_temp (symbol, date, dividend) VALUES (?, ?, ?)",
+                            "sql": "INSERT OR REPLACE INTO dividend_history_temp (symbol, date, dividend) VALUES (?, ?, ?)",
                             "params": [symbol, row['Date'].strftime('%Y-%m-%d'), row.iloc[1]] 
                         })
                 else:
@@ -314,10 +328,35 @@ def fetch_and_overwrite_market_data(targets, benchmark_symbols, global_earliest_
     else:
         print("\n未找到任何需要更新的股利數據。")
     # ========================= 【全新整合的獨立、過濾後股利抓取步驟 - 結束】 =========================
-    
+    return True
+
+
+def swap_temp_tables():
+    """將臨時表原子性替換為正式表，並依臨時表內容更新 market_data_coverage"""
     print("\n步驟 5/5: 所有數據已寫入臨時表，準備執行原子性替換...")
+    # 週末租約已阻止新的每日更新啟動，這裡等待替換前仍在執行的每日更新結束，避免其寫入正在被替換的資料表
+    if not wait_for_lease_drain(DAILY_LEASE):
+        print("FATAL: 每日更新仍在執行，放棄本次原子性替換。")
+        return False
+    # 預熱同樣直接寫入正式表，替換前也需等待其結束
+    if not wait_for_lease_drain(PREWARM_LEASE):
+        print("FATAL: 宇宙預熱仍在執行，放棄本次原子性替換。")
+        return False
+    today_str = datetime.now().strftime('%Y-%m-%d')
+    # 分片模式下各分片處理的標的分散在不同程序中，因此直接以臨時表內容作為成功處理的標的清單
+    processed_sql = "SELECT DISTINCT symbol FROM price_history_temp UNION SELECT DISTINCT symbol FROM exchange_rates_temp"
+    all_symbols_successfully_processed = [row['symbol'] for row in d1_query(processed_sql)]
     
+    # 預熱宇宙的標的：未持有者不在本次刷新範圍內，已持有者只刷新到首次交易日；
+    # 將臨時表最早日期之前 (未持有者為全部) 的既有數據帶入臨時表，避免替換後遺失預熱的歷史並與 market_data_coverage 不一致
+    carry_over_source = """
+        FROM {table} h
+        LEFT JOIN (SELECT symbol, MIN(date) AS min_date FROM price_history_temp GROUP BY symbol) t ON t.symbol = h.symbol
+        WHERE h.symbol IN (SELECT symbol FROM prewarm_universe) AND (t.min_date IS NULL OR h.date < t.min_date)
+    """
     swap_statements = [
+        {"sql": f"INSERT OR IGNORE INTO dividend_history_temp (symbol, date, dividend) SELECT h.symbol, h.date, h.dividend {carry_over_source.format(table='dividend_history')};"},
+        {"sql": f"INSERT OR IGNORE INTO price_history_temp (symbol, date, price) SELECT h.symbol, h.date, h.price {carry_over_source.format(table='price_history')};"},
         {"sql": "ALTER TABLE price_history RENAME TO price_history_old;"},
         {"sql": "ALTER TABLE price_history_temp RENAME TO price_history;"},
         {"sql": "ALTER TABLE dividend_history RENAME TO dividend_history_old;"},
@@ -337,9 +376,14 @@ def fetch_and_overwrite_market_data(targets, benchmark_symbols, global_earliest_
             all_first_tx_sql = f"SELECT symbol, MIN(date) as first_tx_date FROM transactions WHERE symbol IN ({placeholders}) GROUP BY symbol"
             first_tx_dates_results = d1_query(all_first_tx_sql, unique_processed_symbols)
             first_tx_dates = {row['symbol']: row['first_tx_date'].split('T')[0] for row in first_tx_dates_results if row.get('first_tx_date')}
+            # 預熱宇宙的標的保留既有涵蓋起點 (預熱回溯起點) 與首次交易日兩者較早者，其更早的歷史已於替換時帶入
+            universe_coverage_sql = f"SELECT c.symbol AS symbol, c.earliest_date AS earliest_date FROM market_data_coverage c JOIN prewarm_universe u ON u.symbol = c.symbol WHERE c.symbol IN ({placeholders})"
+            universe_coverage = {row['symbol']: row['earliest_date'].split('T')[0] for row in d1_query(universe_coverage_sql, unique_processed_symbols) if row.get('earliest_date')}
 
             for symbol in unique_processed_symbols:
                 symbol_start_date = first_tx_dates.get(symbol, "2000-01-01")
+                if symbol in universe_coverage:
+                    symbol_start_date = min(symbol_start_date, universe_coverage[symbol])
                 if symbol_start_date:
                     coverage_updates.append({
                         "sql": "INSERT OR REPLACE INTO market_data_coverage (symbol, earliest_date, last_updated) VALUES (?, ?, ?)",
@@ -363,9 +407,231 @@ def fetch_and_overwrite_market_data(targets, benchmark_symbols, global_earliest_
         print(f"FATAL: 原子性替換數據失敗！資料庫可能處於不一致狀態，請手動檢查。")
         return False
 
+
+def fetch_and_overwrite_market_data(targets, benchmark_symbols, global_earliest_tx_date):
+    """單一程序模式：初始化臨時表、抓取所有標的，最後執行原子性替換"""
+    if not targets:
+        print("沒有需要刷新的標的。")
+        return False # 【修正】回傳狀態
+    if not prepare_temp_tables():
+        return False
+    if not fetch_into_temp_tables(targets, benchmark_symbols, global_earliest_tx_date):
+        return False
+    return swap_temp_tables()
+
 # ========================= 【核心優化 B - 結束】 =========================
 
 
+# ========================= 【市場宇宙預熱 - 開始】 =========================
+# == 新增：預先為大型股宇宙 (Top 500 US Large Cap) 批次抓取並儲存歷史數據，
+# == 並讓 market_data_coverage 涵蓋到設定的回溯起點，使新標的的首次重算可直接讀取已儲存的數據
+# =========================================================================================
+def d1_batch_chunked(statements, chunk_size=5000):
+    """將大量寫入拆成多個 D1 批次依序送出，任一批次失敗即回傳 False"""
+    for i in range(0, len(statements), chunk_size):
+        if not d1_batch(statements[i:i + chunk_size]):
+            return False
+    return True
+
+def load_prewarm_universe():
+    """讀取預熱宇宙：環境變數 PREWARM_UNIVERSE (逗號分隔，與 Fetch Top 500 工作流程的輸出格式相同) 會被寫入 prewarm_universe 表並與既有清單合併"""
+    d1_batch([{"sql": "CREATE TABLE IF NOT EXISTS prewarm_universe (symbol TEXT PRIMARY KEY, added_at TEXT);"}])
+    env_universe = [canonical_symbol(s) for s in os.environ.get("PREWARM_UNIVERSE", "").split(",") if s.strip()]
+    if env_universe:
+        today_str = datetime.now().strftime('%Y-%m-%d')
+        statements = [{"sql": "INSERT OR IGNORE INTO prewarm_universe (symbol, added_at) VALUES (?, ?)", "params": [s, today_str]} for s in env_universe]
+        if not d1_batch_chunked(statements):
+            print("警告: 寫入 prewarm_universe 失敗，本次僅使用環境變數中的清單。")
+            return sorted(set(env_universe))
+    stored_universe = [canonical_symbol(row['symbol']) for row in d1_query("SELECT symbol FROM prewarm_universe")]
+    return sorted(set(env_universe) | set(stored_universe))
+
+def prewarm_universe_market_data(batch_size=20):
+    """
+    為預熱宇宙中的每個標的確保歷史數據涵蓋到 PREWARM_HORIZON_YEARS 年前並更新至最新：
+    尚未涵蓋到回溯起點的標的從起點完整抓取，其餘只抓取最新一筆之後的增量。
+    """
+    universe = load_prewarm_universe()
+    if not universe:
+        print("預熱宇宙為空 (未設定 PREWARM_UNIVERSE 且 prewarm_universe 表無資料)，跳過預熱。")
+        return True
+
+    horizon_start = (datetime.now() - timedelta(days=365 * PREWARM_HORIZON_YEARS)).strftime('%Y-%m-%d')
+    today_str = datetime.now().strftime('%Y-%m-%d')
+    print(f"\n--- 【市場宇宙預熱】共 {len(universe)} 個標的，回溯起點 {horizon_start} ---")
+
+    # D1 的 SQL 參數數量有限制，需要分批查詢
+    coverage, latest_dates = {}, {}
+    chunk_size = 50
+    for i in range(0, len(universe), chunk_size):
+        chunk = universe[i:i + chunk_size]
+        placeholders = ','.join('?' for _ in chunk)
+        for row in d1_query(f"SELECT symbol, earliest_date FROM market_data_coverage WHERE symbol IN ({placeholders})", chunk):
+            coverage[row['symbol']] = row['earliest_date'].split('T')[0]
+        for row in d1_query(f"SELECT symbol, MAX(date) as latest_date FROM price_history WHERE symbol IN ({placeholders}) GROUP BY symbol", chunk):
+            if row.get('latest_date'):
+                latest_dates[row['symbol']] = row['latest_date'].split('T')[0]
+
+    start_dates = {}
+    for symbol in universe:
+        if symbol not in coverage or coverage[symbol] > horizon_start or symbol not in latest_dates:
+            start_dates[symbol] = horizon_start
+        elif latest_dates[symbol] < today_str:
+            start_dates[symbol] = (datetime.strptime(latest_dates[symbol], '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+    if not start_dates:
+        print("預熱宇宙中所有標的的數據皆已涵蓋且為最新。")
+        return True
+    cold_symbols = [s for s, d in start_dates.items() if d == horizon_start]
+    print(f"需完整回補 {len(cold_symbols)} 個標的，增量更新 {len(start_dates) - len(cold_symbols)} 個標的。")
+
+    # 依起始日期排序後分批，讓同一批次的下載區間盡量接近
+    symbols_to_fetch = sorted(start_dates, key=lambda s: (start_dates[s], s))
+    symbol_batches = [symbols_to_fetch[i:i + batch_size] for i in range(0, len(symbols_to_fetch), batch_size)]
+    end_date_for_fetch = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+    all_batches_ok = True
+
+    for i, batch in enumerate(symbol_batches):
+        print(f"\n--- 正在預熱批次 {i+1}/{len(symbol_batches)}: {batch} ---")
+        batch_start = min(start_dates[s] for s in batch)
+        def yf_prewarm_func():
+            return yf.download(tickers=batch, start=batch_start, end=end_date_for_fetch, interval="1d", auto_adjust=False, back_adjust=False, actions=True, progress=False)
+        data = robust_request(yf_prewarm_func, name="YFinance Prewarm Download")
+        if data is None or data.empty:
+            all_batches_ok = False
+            continue
+        if isinstance(data.columns, pd.MultiIndex):
+            data.columns = data.columns.set_levels([lvl.upper() for lvl in data.columns.levels[1]], level=1)
+
+        db_ops, coverage_updates = [], []
+        for symbol in batch:
+            if isinstance(data.columns, pd.MultiIndex):
+                try:
+                    symbol_data = data.loc[:, (slice(None), symbol)]
+                    symbol_data.columns = symbol_data.columns.droplevel(1)
+                except KeyError:
+                    continue
+            elif len(batch) == 1:
+                symbol_data = data
+            else:
+                print("  -> [警告] yfinance 返回了無法識別的單一格式。")
+                break
+
+            if symbol_data.empty or 'Close' not in symbol_data.columns:
+                continue
+            symbol_data = symbol_data.dropna(subset=['Close'])
+            symbol_data = symbol_data[symbol_data.index >= pd.to_datetime(start_dates[symbol])]
+            if symbol_data.empty:
+                continue
+
+            for _, row in symbol_data[['Close']].reset_index().iterrows():
+                db_ops.append({"sql": "INSERT INTO price_history (symbol, date, price) VALUES (?, ?, ?) ON CONFLICT(symbol, date) DO UPDATE SET price = excluded.price;", "params": [symbol, row['Date'].strftime('%Y-%m-%d'), row['Close']]})
+            if 'Dividends' in symbol_data.columns:
+                for _, row in symbol_data[symbol_data['Dividends'] > 0][['Dividends']].reset_index().iterrows():
+                    db_ops.append({"sql": "INSERT INTO dividend_history (symbol, date, dividend) VALUES (?, ?, ?) ON CONFLICT(symbol, date) DO UPDATE SET dividend = excluded.dividend;", "params": [symbol, row['Date'].strftime('%Y-%m-%d'), row['Dividends']]})
+            # 已完整回補的標的涵蓋起點即為回溯起點；增量更新的標的沿用原有的涵蓋起點
+            coverage_updates.append({
+                "sql": "INSERT OR REPLACE INTO market_data_coverage (symbol, earliest_date, last_updated) VALUES (?, ?, ?)",
+                "params": [symbol, horizon_start if start_dates[symbol] == horizon_start else coverage[symbol], today_str]
+            })
+
+        if db_ops and d1_batch_chunked(db_ops):
+            print(f"成功！ 已寫入 {len(db_ops)} 筆預熱數據。")
+            if coverage_updates and not d1_batch(coverage_updates):
+                print("警告: 更新 market_data_coverage 狀態失敗。")
+        elif db_ops:
+            print(f"FATAL: 預熱批次 {batch} 寫入失敗！")
+            all_batches_ok = False
+
+    return all_batches_ok
+
+# ========================= 【市場宇宙預熱 - 結束】 =========================
+
+
+# ========================= 【分片刷新 - 開始】 =========================
+# == 新增：將標的以穩定雜湊分配到 N 個分片，各分片可由本機多程序或 CI matrix 平行執行，
+# == 最後由協調步驟確認所有分片完成後才進行原子性替換與全局快取失效
+# =========================================================================================
+def get_shard_index(symbol, shard_count):
+    """以 CRC32 計算穩定的分片編號 (Python 內建 hash 每個程序的種子不同，不能用於跨程序分片)"""
+    return zlib.crc32(canonical_symbol(symbol).encode('utf-8')) % shard_count
+
+def init_sharded_refresh(run_id, shard_count):
+    """協調步驟 (開始)：初始化臨時表，並為本次執行的每個分片建立待完成紀錄"""
+    print(f"\n--- 【分片刷新】初始化執行 {run_id}，共 {shard_count} 個分片 ---")
+    if not prepare_temp_tables():
+        return False
+    statements = [
+        {"sql": "CREATE TABLE IF NOT EXISTS weekend_refresh_shards (run_id TEXT, shard_index INTEGER, shard_count INTEGER, status TEXT, symbol_count INTEGER, updated_at TEXT, PRIMARY KEY(run_id, shard_index));"},
+        {"sql": "DELETE FROM weekend_refresh_shards WHERE run_id != ?", "params": [run_id]},
+    ]
+    now_str = datetime.now().isoformat()
+    for shard_index in range(shard_count):
+        statements.append({
+            "sql": "INSERT OR REPLACE INTO weekend_refresh_shards (run_id, shard_index, shard_count, status, symbol_count, updated_at) VALUES (?, ?, ?, 'pending', 0, ?)",
+            "params": [run_id, shard_index, shard_count, now_str]
+        })
+    if not d1_batch(statements):
+        print("FATAL: 建立分片狀態紀錄失敗。")
+        return False
+    return True
+
+def clear_shard_temp_rows(shard_targets):
+    """刪除本分片標的在三張臨時表中的既有列"""
+    statements = []
+    chunk_size = 50
+    for i in range(0, len(shard_targets), chunk_size):
+        chunk = shard_targets[i:i + chunk_size]
+        placeholders = ','.join('?' for _ in chunk)
+        for table in ("price_history_temp", "dividend_history_temp", "exchange_rates_temp"):
+            statements.append({"sql": f"DELETE FROM {table} WHERE symbol IN ({placeholders})", "params": chunk})
+    if statements and not d1_batch(statements):
+        print("FATAL: 清除本分片的臨時表數據失敗。")
+        return False
+    return True
+
+def run_refresh_shard(run_id, shard_index, shard_count):
+    """分片步驟：只抓取雜湊到本分片的標的並寫入共用的臨時表，完成後回報狀態"""
+    print(f"\n--- 【分片刷新】執行分片 {shard_index + 1}/{shard_count} (run: {run_id}) ---")
+    targets, benchmark_symbols, _, global_earliest_tx_date = get_full_refresh_targets()
+    shard_targets = [s for s in targets if get_shard_index(s, shard_count) == shard_index]
+    print(f"分片 {shard_index} 分配到 {len(shard_targets)} 個標的: {shard_targets}")
+
+    # 重跑 (Re-run failed jobs) 時先清除本分片上一次嘗試寫入臨時表的數據，使分片可重複執行
+    success = clear_shard_temp_rows(shard_targets) and fetch_into_temp_tables(shard_targets, benchmark_symbols, global_earliest_tx_date)
+    status = 'done' if success else 'failed'
+    d1_batch([{
+        "sql": "UPDATE weekend_refresh_shards SET status = ?, symbol_count = ?, updated_at = ? WHERE run_id = ? AND shard_index = ?",
+        "params": [status, len(shard_targets), datetime.now().isoformat(), run_id, shard_index]
+    }])
+    print(f"分片 {shard_index} 執行結果: {status}")
+    return success
+
+def finalize_sharded_refresh(run_id, shard_count):
+    """協調步驟 (結束)：確認所有分片皆已完成，才執行原子性替換"""
+    print(f"\n--- 【分片刷新】檢查執行 {run_id} 的分片完成狀態 ---")
+    rows = d1_query("SELECT shard_index, status FROM weekend_refresh_shards WHERE run_id = ? AND shard_count = ?", [run_id, shard_count])
+    done_shards = {row['shard_index'] for row in rows if row.get('status') == 'done'}
+    missing_shards = [i for i in range(shard_count) if i not in done_shards]
+    if missing_shards:
+        print(f"FATAL: 分片 {missing_shards} 尚未成功完成，放棄原子性替換以確保數據一致性。")
+        return False
+    print(f"所有 {shard_count} 個分片皆已完成。")
+    return swap_temp_tables()
+
+def run_local_sharded_refresh(run_id, shard_count):
+    """以本機程序池平行執行所有分片，並在全部完成後執行協調步驟"""
+    if not init_sharded_refresh(run_id, shard_count):
+        return False
+    with ProcessPoolExecutor(max_workers=shard_count) as executor:
+        results = list(executor.map(run_refresh_shard, [run_id] * shard_count, range(shard_count), [shard_count] * shard_count))
+    if not all(results):
+        print("警告: 部分分片執行失敗。")
+    return finalize_sharded_refresh(run_id, shard_count)
+
+# ========================= 【分片刷新 - 結束】 =========================
+
+
 def trigger_recalculations(uids):
     """觸發所有使用者的後端重算"""
     if not uids:
@@ -396,25 +662,136 @@ def trigger_recalculations(uids):
         print("觸發重算最終失敗。")
 
 
-if __name__ == "__main__":
-    print(f"--- 開始執行週末市場數據完整校驗腳本 (v3.6 - Adaptive Data Parsing) --- {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    refresh_targets, benchmark_symbols, all_uids, global_start_date = get_full_refresh_targets()
-    if refresh_targets:
-        success = fetch_and_overwrite_market_data(refresh_targets, benchmark_symbols, global_start_date)
-        
-        if success:
-            print("\n--- 【全局快取失效階段】偵測到價格數據已成功刷新，正在將所有群組標記為 dirty... ---")
-            invalidate_sql = "UPDATE groups SET is_dirty = 1"
-            if d1_batch([{"sql": invalidate_sql, "params": []}]):
-                print("成功！所有自訂群組的快取都已被標記為需要重新計算。")
-            else:
-                print("FATAL: 全局快取失效操作失敗！")
-            
+def migrate_canonical_symbols():
+    """
+    一次性遷移：將既有資料列的股票代碼統一為標準形式 (upper(trim(symbol)))。
+    以 (symbol, date) 或 symbol 為主鍵的表先以 INSERT OR IGNORE 複製為標準代碼 (已存在的標準列優先保留)，再刪除非標準列；
+    其餘表直接就地更新。完成後所有市場數據查詢皆可使用單純的等值/範圍條件命中索引。
+    """
+    print("\n--- 【代碼正規化遷移】開始將既有資料的股票代碼統一為標準形式 ---")
+    non_canonical = "symbol != upper(trim(symbol))"
+    statements = []
+    keyed_tables = {
+        "price_history": "date, price",
+        "exchange_rates": "date, price",
+        "dividend_history": "date, dividend",
+        "market_data_coverage": "earliest_date, last_updated",
+    }
+    for table, columns in keyed_tables.items():
+        statements.append({"sql": f"INSERT OR IGNORE INTO {table} (symbol, {columns}) SELECT upper(trim(symbol)), {columns} FROM {table} WHERE {non_canonical};"})
+        statements.append({"sql": f"DELETE FROM {table} WHERE {non_canonical};"})
+    for table in ("transactions", "splits", "user_dividends"):
+        statements.append({"sql": f"UPDATE {table} SET symbol = upper(trim(symbol)) WHERE {non_canonical};"})
+    # holdings 與 user_pending_dividends 為重算產生的快取，衝突的舊列直接刪除，下次重算會重建
+    for table in ("holdings", "user_pending_dividends"):
+        statements.append({"sql": f"UPDATE OR IGNORE {table} SET symbol = upper(trim(symbol)) WHERE {non_canonical};"})
+        statements.append({"sql": f"DELETE FROM {table} WHERE {non_canonical};"})
+    statements.append({"sql": "UPDATE controls SET value = upper(trim(value)) WHERE key = 'benchmarkSymbol' AND value != upper(trim(value));"})
+    statements.append({"sql": "CREATE INDEX IF NOT EXISTS idx_transactions_symbol ON transactions (symbol);"})
+
+    if d1_batch(statements):
+        print("成功！所有既有資料的股票代碼皆已正規化。")
+        return True
+    print("FATAL: 代碼正規化遷移失敗！")
+    return False
+
+
+def rebuild_price_history_twd(targets):
+    """原子性替換後，移除正式表中已不存在的台幣價格列，並對完整歷史重新比對、補寫 price_history_twd"""
+    cleanup_statements = [
+        {"sql": PRICE_HISTORY_TWD_DDL},
+        {"sql": "DELETE FROM price_history_twd WHERE symbol NOT LIKE '%=%' AND NOT EXISTS (SELECT 1 FROM price_history p WHERE p.symbol = price_history_twd.symbol AND p.date = price_history_twd.date);"},
+        {"sql": "DELETE FROM price_history_twd WHERE symbol LIKE '%=%' AND NOT EXISTS (SELECT 1 FROM exchange_rates e WHERE e.symbol = price_history_twd.symbol AND e.date = price_history_twd.date);"},
+    ]
+    if not d1_batch(cleanup_statements):
+        print("警告: 清理 price_history_twd 失敗。")
+    refresh_price_history_twd(targets)
+
+
+def invalidate_all_groups():
+    """全局快取失效：將所有群組標記為 dirty"""
+    print("\n--- 【全局快取失效階段】偵測到價格數據已成功刷新，正在將所有群組標記為 dirty... ---")
+    invalidate_sql = "UPDATE groups SET is_dirty = 1"
+    if d1_batch([{"sql": invalidate_sql, "params": []}]):
+        print("成功！所有自訂群組的快取都已被標記為需要重新計算。")
+    else:
+        print("FATAL: 全局快取失效操作失敗！")
+
+
+def run_weekend_entry(args):
+    """依命令列參數執行對應的週末流程 (需在取得週末租約後呼叫)"""
+    if args.prewarm:
+        if not prewarm_universe_market_data():
+            raise SystemExit(1)
+    elif args.migrate_symbols:
+        if not migrate_canonical_symbols():
+            raise SystemExit(1)
+    elif args.init:
+        if not init_sharded_refresh(args.run_id, args.shard_count):
+            raise SystemExit(1)
+    elif args.shard_index is not None:
+        if not run_refresh_shard(args.run_id, args.shard_index, args.shard_count):
+            raise SystemExit(1)
+    elif args.finalize:
+        if finalize_sharded_refresh(args.run_id, args.shard_count):
+            refresh_targets, _, all_uids, _ = get_full_refresh_targets()
+            rebuild_price_history_twd(refresh_targets)
+            if MARKET_SNAPSHOT_PATH:
+                export_market_snapshot(MARKET_SNAPSHOT_PATH, full_rebuild=True)
+            invalidate_all_groups()
             if all_uids:
                 trigger_recalculations(all_uids)
         else:
             print("\n--- 【終止】由於市場數據刷新失敗，已跳過後續的快取失效與重算步驟，以確保數據一致性。 ---")
-
+            raise SystemExit(1)
     else:
-        print("資料庫中沒有找到任何需要刷新的標的 (無持股、無Benchmark)。")
+        refresh_targets, benchmark_symbols, all_uids, global_start_date = get_full_refresh_targets()
+        if refresh_targets:
+            if args.shard_count > 1:
+                success = run_local_sharded_refresh(args.run_id, args.shard_count)
+            else:
+                success = fetch_and_overwrite_market_data(refresh_targets, benchmark_symbols, global_start_date)
+
+            if success:
+                rebuild_price_history_twd(refresh_targets)
+                if MARKET_SNAPSHOT_PATH:
+                    export_market_snapshot(MARKET_SNAPSHOT_PATH, full_rebuild=True)
+                invalidate_all_groups()
+                if all_uids:
+                    trigger_recalculations(all_uids)
+            else:
+                print("\n--- 【終止】由於市場數據刷新失敗，已跳過後續的快取失效與重算步驟，以確保數據一致性。 ---")
+
+        else:
+            print("資料庫中沒有找到任何需要刷新的標的 (無持股、無Benchmark)。")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="週末市場數據完整校驗腳本")
+    parser.add_argument("--shard-count", type=int, default=1, help="將標的分配到的分片數量")
+    parser.add_argument("--shard-index", type=int, help="只執行指定的分片 (CI matrix 模式)")
+    parser.add_argument("--init", action="store_true", help="CI matrix 模式的協調步驟：初始化臨時表與分片狀態")
+    parser.add_argument("--finalize", action="store_true", help="CI matrix 模式的協調步驟：確認所有分片完成後執行替換、快取失效與重算")
+    parser.add_argument("--prewarm", action="store_true", help="為預熱宇宙 (PREWARM_UNIVERSE / prewarm_universe 表) 批次抓取並儲存歷史數據")
+    parser.add_argument("--migrate-symbols", action="store_true", help="一次性遷移：將既有資料的股票代碼統一為標準形式")
+    parser.add_argument("--run-id", default=os.environ.get("WEEKEND_REFRESH_RUN_ID") or datetime.now().strftime('%Y%m%d%H%M%S'), help="分片執行的識別碼，同一次刷新的所有步驟必須一致")
+    args = parser.parse_args()
+
+    print(f"--- 開始執行週末市場數據完整校驗腳本 (v3.12 - Market Data Snapshot File) --- {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    # 同一次刷新的所有 CI job 以 run_id 作為持有者，可在各 job 間延續同一份租約；
+    # 預熱不替換資料表，改用獨立租約，避免在美股盤前時段阻擋每日更新
+    lease_name = PREWARM_LEASE if args.prewarm else WEEKEND_LEASE
+    if not acquire_run_lease(lease_name, args.run_id):
+        print(f"已有其他執行持有 {lease_name}，本次執行直接結束。")
+        raise SystemExit(0)
+    heartbeat = start_lease_heartbeat(lease_name, args.run_id)
+    # init 與分片步驟結束後仍保留租約給後續 job；其餘模式為流程終點，結束時釋放
+    release_lease_on_exit = not args.init and args.shard_index is None
+
+    try:
+        run_weekend_entry(args)
+    finally:
+        heartbeat.set()
+        if release_lease_on_exit:
+            release_run_lease(lease_name, args.run_id)
     print(f"--- 週末市場數據完整校驗腳本執行完畢 --- {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
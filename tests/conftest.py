@@ -0,0 +1,26 @@
+import sqlite3
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def fake_d1(monkeypatch):
+    """以 SQLite 記憶體資料庫代替 D1 Worker (D1 即為 SQLite，SQL 可原樣執行)；各測試自行建立所需的表"""
+    db = sqlite3.connect(":memory:")
+    db.row_factory = sqlite3.Row
+
+    def d1_query(sql, params=None, api_key=None):
+        return [dict(row) for row in db.execute(sql, params or [])]
+
+    def d1_batch(statements, api_key=None):
+        for stmt in statements:
+            db.execute(stmt["sql"], stmt.get("params", []))
+        db.commit()
+        return True
+
+    monkeypatch.setattr(main, "d1_query", d1_query)
+    monkeypatch.setattr(main, "d1_batch", d1_batch)
+    yield db
+    db.close()
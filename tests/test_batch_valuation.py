@@ -0,0 +1,123 @@
+# =========================================================================================
+# == 批次估值快照 (run_batch_valuation_snapshots) 與後端計算引擎的一致性測試
+# == 同一組投資組合分別以 Python 矩陣估值與 Node 端 getPortfolioStateOnDate / dailyValue 重播，
+# == 兩者寫出的每日市值與快照成本必須相同 (後端增量重算會直接沿用批次估值寫入的歷史與快照)
+# =========================================================================================
+
+import json
+import shutil
+import subprocess
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+import main
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+SCHEMA = """
+CREATE TABLE transactions (id TEXT, uid TEXT, date TEXT, symbol TEXT, type TEXT, quantity REAL, price REAL, currency TEXT, totalCost REAL, exchangeRate REAL);
+CREATE TABLE splits (id TEXT, uid TEXT, date TEXT, symbol TEXT, ratio REAL);
+CREATE TABLE price_history (symbol TEXT, date TEXT, price REAL, PRIMARY KEY(symbol, date));
+CREATE TABLE exchange_rates (symbol TEXT, date TEXT, price REAL, PRIMARY KEY(symbol, date));
+CREATE TABLE portfolio_summary (uid TEXT, group_id TEXT, history TEXT);
+CREATE TABLE portfolio_snapshots (uid TEXT, group_id TEXT, snapshot_date TEXT, market_value_twd REAL, total_cost_twd REAL, PRIMARY KEY(uid, group_id, snapshot_date));
+"""
+
+TRANSACTIONS = [
+    # 美股：兩筆買入後部分賣出 (跨兩個 FIFO 批次)，之後 1 拆 4
+    {"date": "2024-01-02", "symbol": "AAPL", "type": "buy", "quantity": 10, "price": 100.0, "currency": "USD", "totalCost": 1000.0},
+    {"date": "2024-01-04", "symbol": "aapl", "type": "buy", "quantity": 5, "price": 110.0, "currency": "USD", "totalCost": None},
+    {"date": "2024-01-09", "symbol": "AAPL", "type": "sell", "quantity": 12, "price": 120.0, "currency": "USD", "totalCost": 1440.0},
+    # 台股：買入後部分賣出
+    {"date": "2024-01-03", "symbol": "2330.TW", "type": "buy", "quantity": 1000, "price": 600.0, "currency": "TWD", "totalCost": 600000.0},
+    {"date": "2024-01-10", "symbol": "2330.TW", "type": "sell", "quantity": 400, "price": 620.0, "currency": "TWD", "totalCost": 248000.0},
+]
+SPLITS = [{"date": "2024-01-11", "symbol": "AAPL", "ratio": 4.0}]
+
+TRADING_DAYS = [d for d in pd.bdate_range("2024-01-02", "2024-01-19").strftime("%Y-%m-%d") if d != "2024-01-15"]
+# 價格為拆股調整後的收盤價 (與 yfinance 一致)
+AAPL_PRICES = {d: 25.0 + i * 0.5 for i, d in enumerate(TRADING_DAYS)}
+TW_PRICES = {d: 600.0 + i * 3 for i, d in enumerate(TRADING_DAYS) if d != "2024-01-08"}
+# 缺 01-04 (買入日) 與 01-12 的匯率，兩端都應沿用前一筆
+USD_RATES = {d: 31.0 + i * 0.1 for i, d in enumerate(TRADING_DAYS) if d not in ("2024-01-04", "2024-01-12")}
+
+# 後端 state.calculator 逐日重播，輸出每日市值與每日成本
+NODE_REPLAY = """
+const { prepareEvents, getPortfolioStateOnDate, dailyValue } = require('./functions/calculation/state.calculator');
+const { txs, splits, market, dates } = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+const { evts } = prepareEvents(txs, splits, market, []);
+const out = {};
+for (const dateStr of dates) {
+    const date = new Date(dateStr);
+    const state = getPortfolioStateOnDate(evts, date, market);
+    const cost = Object.values(state).reduce((s, stk) => s + stk.lots.reduce((ls, l) => ls + l.quantity * l.pricePerShareTWD, 0), 0);
+    out[dateStr] = { value: dailyValue(state, market, date, evts), cost };
+}
+process.stdout.write(JSON.stringify(out));
+"""
+
+
+def seed_portfolio(db, uid):
+    db.executescript(SCHEMA)
+    for i, tx in enumerate(TRANSACTIONS):
+        db.execute("INSERT INTO transactions (id, uid, date, symbol, type, quantity, price, currency, totalCost) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   [f"tx{i}", uid, tx["date"], tx["symbol"], tx["type"], tx["quantity"], tx["price"], tx["currency"], tx["totalCost"]])
+    for i, split in enumerate(SPLITS):
+        db.execute("INSERT INTO splits (id, uid, date, symbol, ratio) VALUES (?, ?, ?, ?, ?)", [f"sp{i}", uid, split["date"], split["symbol"], split["ratio"]])
+    for table, symbol, series in (("price_history", "AAPL", AAPL_PRICES), ("price_history", "2330.TW", TW_PRICES), ("exchange_rates", "TWD=X", USD_RATES)):
+        db.executemany(f"INSERT INTO {table} (symbol, date, price) VALUES (?, ?, ?)", [(symbol, d, v) for d, v in series.items()])
+    # 後端已連續算到變動起始日前一天，符合批次估值的處理條件
+    db.execute("INSERT INTO portfolio_summary (uid, group_id, history) VALUES (?, 'all', '{}')", [uid])
+    db.execute("INSERT INTO portfolio_snapshots (uid, group_id, snapshot_date, market_value_twd, total_cost_twd) VALUES (?, 'all', '2024-01-01', 0, 0)", [uid])
+    db.commit()
+
+
+def replay_in_node(dates):
+    market = {
+        "AAPL": {"prices": AAPL_PRICES, "dividends": {}},
+        "2330.TW": {"prices": TW_PRICES, "dividends": {}},
+        "TWD=X": {"rates": USD_RATES},
+    }
+    payload = {"txs": TRANSACTIONS, "splits": SPLITS, "market": market, "dates": dates}
+    result = subprocess.run(["node", "-e", NODE_REPLAY], input=json.dumps(payload), capture_output=True, text=True, cwd=REPO_ROOT, check=True)
+    return json.loads(result.stdout)
+
+
+def test_fifo_replay_handles_partial_sells_across_lots():
+    txs = pd.DataFrame([
+        {"date": "2024-01-02", "type": "buy", "adj_quantity": 10.0, "cost_twd": 1000.0},
+        {"date": "2024-01-03", "type": "buy", "adj_quantity": 5.0, "cost_twd": 600.0},
+        {"date": "2024-01-04", "type": "sell", "adj_quantity": 12.0, "cost_twd": 1500.0},
+        {"date": "2024-01-05", "type": "sell", "adj_quantity": 5.0, "cost_twd": 500.0},
+        {"date": "2024-01-08", "type": "buy", "adj_quantity": 4.0, "cost_twd": 440.0},
+    ])
+    steps = main.replay_fifo_lots(txs)
+    assert [(d, q) for d, q, _ in steps] == [("2024-01-02", 10), ("2024-01-03", 15), ("2024-01-04", 3), ("2024-01-05", -2), ("2024-01-08", 2)]
+    # 賣出 12 股時先沖銷第一批 10 股，再從第二批 (每股 120) 扣 2 股，剩 3 股成本 360
+    assert steps[2][2] == pytest.approx(360.0)
+    # 超賣 2 股形成空頭 (每股 100)；買入 4 股先回補空頭，剩 2 股以買入價計 (每股 110)
+    assert steps[3][2] == pytest.approx(-200.0)
+    assert steps[4][2] == pytest.approx(220.0)
+
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="需要 Node.js 執行後端計算引擎")
+def test_batch_valuation_matches_backend_daily_values(fake_d1):
+    seed_portfolio(fake_d1, "u1")
+
+    main.run_batch_valuation_snapshots("2024-01-02")
+
+    history = json.loads(fake_d1.execute("SELECT history FROM portfolio_summary WHERE uid = 'u1'").fetchone()["history"])
+    assert min(history) == "2024-01-02"
+    expected = replay_in_node(sorted(history))
+    for date_str in sorted(history):
+        assert history[date_str] == pytest.approx(expected[date_str]["value"], rel=1e-9), date_str
+
+    snapshot = fake_d1.execute("SELECT * FROM portfolio_snapshots WHERE uid = 'u1' ORDER BY snapshot_date DESC LIMIT 1").fetchone()
+    last_date = max(history)
+    assert snapshot["snapshot_date"] == last_date
+    assert snapshot["market_value_twd"] == pytest.approx(expected[last_date]["value"], rel=1e-9)
+    assert snapshot["total_cost_twd"] == pytest.approx(expected[last_date]["cost"], rel=1e-9)
+    # 拆股後仍持有 3 股 × 4 = 12 股 AAPL 與 600 股台積電
+    assert snapshot["market_value_twd"] == pytest.approx(12 * AAPL_PRICES["2024-01-19"] * USD_RATES["2024-01-19"] + 600 * TW_PRICES["2024-01-19"])
@@ -0,0 +1,118 @@
+# =========================================================================================
+# == 缺口掃描 (find_missing_date_ranges / expected_gap_dates / get_symbol_market) 測試
+# =========================================================================================
+
+import pandas as pd
+import pytest
+
+import main
+
+
+def stored_rows(symbol, dates):
+    return pd.DataFrame({"symbol": symbol, "date": list(dates)})
+
+
+def calendar(*dates):
+    return pd.DatetimeIndex(pd.to_datetime(list(dates)))
+
+
+# 2024-01-01 (一) 元旦休市，2024-01-15 (一) 馬丁路德紀念日休市
+NYSE_JAN = calendar(*[d for d in pd.bdate_range("2024-01-02", "2024-01-19").strftime("%Y-%m-%d") if d != "2024-01-15"])
+
+
+@pytest.mark.parametrize("symbol, market", [
+    ("AAPL", "NYSE"),
+    ("brk-b", "NYSE"),
+    ("2330.TW", "TPE"),
+    ("6488.two", "TPE"),
+    ("0700.HK", "HKEX"),
+    ("7203.T", "JPX"),
+    ("^GSPC", "NYSE"),
+    ("^TWII", "TPE"),
+    ("^HSI", "HKEX"),
+    ("TWD=X", "FX"),
+    ("VOD.L", "SUFFIX.L"),
+])
+def test_get_symbol_market(symbol, market):
+    assert main.get_symbol_market(symbol) == market
+
+
+def test_interior_hole_is_reported():
+    dates = [d for d in NYSE_JAN.strftime("%Y-%m-%d") if d not in ("2024-01-09", "2024-01-10")]
+    ranges = main.find_missing_date_ranges(stored_rows("AAPL", dates), {"NYSE": NYSE_JAN})
+    assert ranges == {"AAPL": [("2024-01-09", "2024-01-10")]}
+
+
+def test_holes_spanning_weekend_and_holiday_merge_into_one_range():
+    # 缺 01-12 (五) 與 01-16 (二)，中間只隔週末與 01-15 假日，應合併為同一區段
+    dates = [d for d in NYSE_JAN.strftime("%Y-%m-%d") if d not in ("2024-01-12", "2024-01-16")]
+    ranges = main.find_missing_date_ranges(stored_rows("AAPL", dates), {"NYSE": NYSE_JAN})
+    assert ranges == {"AAPL": [("2024-01-12", "2024-01-16")]}
+
+
+def test_separate_holes_stay_separate():
+    dates = [d for d in NYSE_JAN.strftime("%Y-%m-%d") if d not in ("2024-01-04", "2024-01-11")]
+    ranges = main.find_missing_date_ranges(stored_rows("AAPL", dates), {"NYSE": NYSE_JAN})
+    assert ranges == {"AAPL": [("2024-01-04", "2024-01-04"), ("2024-01-11", "2024-01-11")]}
+
+
+def test_other_market_holidays_are_not_gaps():
+    # 港股在美股交易日休市不算缺口，反之亦然
+    hkex = calendar("2024-01-02", "2024-01-03", "2024-01-05")
+    stored = pd.concat([
+        stored_rows("AAPL", NYSE_JAN.strftime("%Y-%m-%d")),
+        stored_rows("0700.HK", ["2024-01-02", "2024-01-03", "2024-01-05"]),
+    ])
+    assert main.find_missing_date_ranges(stored, {"NYSE": NYSE_JAN, "HKEX": hkex}) == {}
+
+
+def test_known_misses_cancel_gaps():
+    dates = [d for d in NYSE_JAN.strftime("%Y-%m-%d") if d not in ("2024-01-09", "2024-01-10")]
+    misses = pd.DataFrame({"symbol": ["AAPL", "AAPL"], "date": ["2024-01-09", "2024-01-10"]})
+    assert main.find_missing_date_ranges(stored_rows("AAPL", dates), {"NYSE": NYSE_JAN}, misses) == {}
+
+    partial = misses.iloc[:1]
+    ranges = main.find_missing_date_ranges(stored_rows("AAPL", dates), {"NYSE": NYSE_JAN}, partial)
+    assert ranges == {"AAPL": [("2024-01-10", "2024-01-10")]}
+
+
+def test_known_misses_of_other_symbols_are_ignored():
+    dates = [d for d in NYSE_JAN.strftime("%Y-%m-%d") if d != "2024-01-09"]
+    stored = pd.concat([stored_rows("AAPL", dates), stored_rows("MSFT", dates)])
+    misses = pd.DataFrame({"symbol": ["MSFT"], "date": ["2024-01-09"]})
+    assert main.find_missing_date_ranges(stored, {"NYSE": NYSE_JAN}, misses) == {"AAPL": [("2024-01-09", "2024-01-09")]}
+
+
+def test_falls_back_to_union_of_stored_dates_without_calendar():
+    full = ["2024-01-02", "2024-01-03", "2024-01-04", "2024-01-05", "2024-01-08"]
+    stored = pd.concat([
+        stored_rows("2330.TW", full + ["2024-01-06"]),  # 週末的零星資料不列入預期日曆
+        stored_rows("2317.TW", ["2024-01-02", "2024-01-05", "2024-01-08"]),
+    ])
+    ranges = main.find_missing_date_ranges(stored)
+    assert ranges == {"2317.TW": [("2024-01-03", "2024-01-04")]}
+
+
+def test_no_gaps_before_first_or_after_last_stored_date():
+    # 晚上市或已停止更新的標的，不應在其首筆之前或末筆之後回報缺口
+    stored = stored_rows("NEWCO", ["2024-01-08", "2024-01-09", "2024-01-10"])
+    assert main.find_missing_date_ranges(stored, {"NYSE": NYSE_JAN}) == {}
+
+
+def test_empty_input_returns_empty():
+    assert main.find_missing_date_ranges(pd.DataFrame(columns=["symbol", "date"])) == {}
+
+
+def test_expected_gap_dates_uses_market_calendar():
+    stored = stored_rows("AAPL", ["2024-01-12"])
+    dates = main.expected_gap_dates("AAPL", "2024-01-12", "2024-01-16", {"NYSE": NYSE_JAN}, stored)
+    assert dates == ["2024-01-12", "2024-01-16"]
+
+
+def test_expected_gap_dates_falls_back_to_same_market_stored_weekdays():
+    stored = pd.concat([
+        stored_rows("2330.TW", ["2024-01-02", "2024-01-03", "2024-01-06", "2024-01-08"]),
+        stored_rows("AAPL", ["2024-01-04"]),
+    ])
+    dates = main.expected_gap_dates("2317.TW", "2024-01-02", "2024-01-08", {}, stored)
+    assert dates == ["2024-01-02", "2024-01-03", "2024-01-08"]
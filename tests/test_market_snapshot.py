@@ -0,0 +1,101 @@
+# =========================================================================================
+# == 市場數據快照檔 (export_market_snapshot) 增量追加測試
+# =========================================================================================
+
+import numpy as np
+import pandas as pd
+
+import main
+
+SCHEMA = """
+CREATE TABLE price_history (symbol TEXT, date TEXT, price REAL, PRIMARY KEY(symbol, date));
+CREATE TABLE exchange_rates (symbol TEXT, date TEXT, price REAL, PRIMARY KEY(symbol, date));
+CREATE TABLE dividend_history (symbol TEXT, date TEXT, dividend REAL, PRIMARY KEY(symbol, date));
+"""
+
+TRADING_DAYS = list(pd.bdate_range("2024-01-02", "2024-01-19").strftime("%Y-%m-%d"))
+
+
+def seed_market(db):
+    db.executescript(SCHEMA)
+    for symbol, base in (("AAPL", 185.0), ("2330.TW", 590.0)):
+        db.executemany("INSERT INTO price_history (symbol, date, price) VALUES (?, ?, ?)", [(symbol, d, base + i) for i, d in enumerate(TRADING_DAYS)])
+    db.executemany("INSERT INTO exchange_rates (symbol, date, price) VALUES (?, ?, ?)", [("TWD=X", d, 31.0 + i / 100) for i, d in enumerate(TRADING_DAYS)])
+    db.execute("INSERT INTO dividend_history (symbol, date, dividend) VALUES ('AAPL', '2024-01-05', 0.24)")
+    db.commit()
+
+
+def decode(snapshot, kind):
+    """把字典編碼的序列還原成 {(symbol, date): value}，並確認沒有重複的 (symbol, date)"""
+    symbols = snapshot["symbols"][snapshot[f"{kind}_symbol"]]
+    dates = snapshot[f"{kind}_date"].astype(str)
+    keys = list(zip(symbols, dates))
+    assert len(keys) == len(set(keys)), f"{kind} 有重複的 (symbol, date)"
+    return dict(zip(keys, snapshot[f"{kind}_value"].tolist()))
+
+
+def table_contents(db, table, value_column):
+    return {(r["symbol"], r["date"]): r["value"] for r in db.execute(f"SELECT symbol, date, {value_column} AS value FROM {table}")}
+
+
+def assert_matches_tables(db, snapshot):
+    for kind, (table, value_column) in main.MARKET_SNAPSHOT_SERIES.items():
+        assert decode(snapshot, kind) == table_contents(db, table, value_column), kind
+
+
+def test_incremental_append_keeps_codes_and_replaces_overlap(fake_d1, tmp_path):
+    seed_market(fake_d1)
+    path = str(tmp_path / "market.npz")
+
+    assert main.export_market_snapshot(path)
+    first = main.load_market_snapshot(path)
+    assert int(first["snapshot_version"]) == 1
+    assert_matches_tables(fake_d1, first)
+
+    # 新標的、重疊區間內的價格修正 (最後日期 01-19 往前 7 天內) 與新的交易日
+    fake_d1.executemany("INSERT INTO price_history (symbol, date, price) VALUES (?, ?, ?)", [("MSFT", "2024-01-18", 390.0), ("MSFT", "2024-01-19", 392.0), ("AAPL", "2024-01-22", 210.0)])
+    fake_d1.execute("UPDATE price_history SET price = 999.0 WHERE symbol = 'AAPL' AND date = '2024-01-17'")
+    fake_d1.execute("INSERT INTO exchange_rates (symbol, date, price) VALUES ('TWD=X', '2024-01-22', 31.5)")
+    fake_d1.commit()
+
+    assert main.export_market_snapshot(path, since_date="2024-01-18")
+    second = main.load_market_snapshot(path)
+
+    assert int(second["snapshot_version"]) == 2
+    assert list(second["symbols"][:len(first["symbols"])]) == list(first["symbols"])
+    assert list(second["symbols"][len(first["symbols"]):]) == ["MSFT"]
+    assert_matches_tables(fake_d1, second)
+    assert decode(second, "prices")[("AAPL", "2024-01-17")] == 999.0
+
+
+def test_incremental_append_replaces_from_since_date_before_overlap(fake_d1, tmp_path):
+    seed_market(fake_d1)
+    path = str(tmp_path / "market.npz")
+    main.export_market_snapshot(path)
+
+    # 早於重疊區間的修正只有在 since_date 涵蓋時才會被重新讀取
+    fake_d1.execute("UPDATE price_history SET price = 1.0 WHERE symbol = '2330.TW' AND date = '2024-01-03'")
+    fake_d1.commit()
+    main.export_market_snapshot(path)
+    assert decode(main.load_market_snapshot(path), "prices")[("2330.TW", "2024-01-03")] == 591.0
+
+    main.export_market_snapshot(path, since_date="2024-01-03")
+    snapshot = main.load_market_snapshot(path)
+    assert int(snapshot["snapshot_version"]) == 3
+    assert_matches_tables(fake_d1, snapshot)
+
+
+def test_full_rebuild_still_increments_version(fake_d1, tmp_path):
+    seed_market(fake_d1)
+    path = str(tmp_path / "market.npz")
+    main.export_market_snapshot(path)
+    fake_d1.execute("DELETE FROM dividend_history")
+    fake_d1.commit()
+
+    main.export_market_snapshot(path, full_rebuild=True)
+    snapshot = main.load_market_snapshot(path)
+
+    assert int(snapshot["snapshot_version"]) == 2
+    assert len(snapshot["dividends_date"]) == 0
+    assert_matches_tables(fake_d1, snapshot)
+    assert np.all(np.diff(snapshot["prices_symbol"]) >= 0)
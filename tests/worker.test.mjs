@@ -0,0 +1,172 @@
+// =========================================================================================
+// == D1 Proxy Worker 市場數據讀取快取測試 (worker.test.mjs)
+// == 以記憶體中的 D1 替身驅動 handleRequest，確認快取命中、失效與略過的行為
+// =========================================================================================
+
+import { test } from 'node:test';
+import assert from 'node:assert/strict';
+import { createQueryCache, handleRequest } from '../worker.js';
+
+const API_KEY = 'test-key';
+
+/**
+ * 最小的 D1 替身：只實作 worker.js 會用到的 prepare().bind().all()/first() 與 batch()，
+ * 並以正則辨識測試中用到的少數語句。executed 記錄每條實際送到資料庫的 SQL，用來判斷快取是否命中
+ */
+function createFakeD1() {
+  const tables = { price_history: [], price_history_temp: [], transactions: [], intraday_quotes: [] };
+  let generation = null;
+  const executed = [];
+
+  const run = (sql, params) => {
+    executed.push(sql);
+    let m;
+    if (/^CREATE TABLE IF NOT EXISTS market_data_generation/i.test(sql)) return [];
+    if (/^INSERT OR IGNORE INTO market_data_generation/i.test(sql)) { if (generation === null) generation = 0; return []; }
+    if (/^SELECT generation FROM market_data_generation/i.test(sql)) return generation === null ? [] : [{ generation }];
+    if (/^UPDATE market_data_generation SET generation = generation \+ 1/i.test(sql)) { generation++; return []; }
+    if ((m = sql.match(/^INSERT INTO (\w+) \(symbol, date, price\) VALUES \(\?, \?, \?\)/i))) {
+      const [symbol, date, price] = params;
+      tables[m[1]] = tables[m[1]].filter(r => !(r.symbol === symbol && r.date === date)).concat([{ symbol, date, price }]);
+      return [];
+    }
+    if ((m = sql.match(/^DROP TABLE IF EXISTS (\w+)/i))) { tables[m[1]] = []; return []; }
+    if ((m = sql.match(/^ALTER TABLE (\w+) RENAME TO (\w+)/i))) { tables[m[2]] = tables[m[1]]; tables[m[1]] = []; return []; }
+    if ((m = sql.match(/^SELECT .* FROM (\w+)(?:\s+\w+)?(?:\s+JOIN\s+(\w+).*)? WHERE (?:\w+\.)?symbol = \?/i))) {
+      return tables[m[1]].filter(r => r.symbol === params[0]);
+    }
+    throw new Error(`Unsupported SQL in fake D1: ${sql}`);
+  };
+
+  const prepare = (sql) => {
+    const bound = (params) => ({
+      sql, params,
+      bind: (...next) => bound(next),
+      all: async () => ({ results: run(sql, params) }),
+      first: async () => run(sql, params)[0] ?? null,
+    });
+    return bound([]);
+  };
+
+  const db = {
+    prepare,
+    batch: async (stmts) => stmts.map(s => ({ success: true, results: run(s.sql, s.params) })),
+  };
+  return { db, tables, executed, getGeneration: () => generation };
+}
+
+function setup() {
+  const fake = createFakeD1();
+  const env = { DB: fake.db, D1_API_KEY: API_KEY };
+  const cache = createQueryCache();
+  const post = async (path, body) => {
+    const response = await handleRequest(new Request(`https://worker.test${path}`, {
+      method: 'POST',
+      headers: { 'X-API-KEY': API_KEY, 'Content-Type': 'application/json' },
+      body: JSON.stringify(body),
+    }), env, cache);
+    return { status: response.status, cacheStatus: response.headers.get('X-Cache'), json: await response.json() };
+  };
+  const countRuns = (sql) => fake.executed.filter(s => s === sql).length;
+  return { fake, cache, post, countRuns };
+}
+
+const PRICE_SQL = 'SELECT date, price FROM price_history WHERE symbol = ?';
+const insertPrice = (table, symbol, date, price) => ({ sql: `INSERT INTO ${table} (symbol, date, price) VALUES (?, ?, ?)`, params: [symbol, date, price] });
+
+test('same SQL and params: MISS then HIT without touching the database again', async () => {
+  const { fake, post, countRuns } = setup();
+  fake.tables.price_history.push({ symbol: 'AAPL', date: '2024-01-02', price: 185 });
+
+  const first = await post('/query', { sql: PRICE_SQL, params: ['AAPL'] });
+  const second = await post('/query', { sql: PRICE_SQL, params: ['AAPL'] });
+  const otherParams = await post('/query', { sql: PRICE_SQL, params: ['MSFT'] });
+
+  assert.equal(first.cacheStatus, 'MISS');
+  assert.equal(second.cacheStatus, 'HIT');
+  assert.deepEqual(second.json, first.json);
+  assert.deepEqual(second.json.results, [{ symbol: 'AAPL', date: '2024-01-02', price: 185 }]);
+  assert.equal(otherParams.cacheStatus, 'MISS');
+  assert.equal(countRuns(PRICE_SQL), 2);
+});
+
+test('a /batch write to price_history invalidates cached reads', async () => {
+  const { fake, post } = setup();
+  fake.tables.price_history.push({ symbol: 'AAPL', date: '2024-01-02', price: 185 });
+
+  await post('/query', { sql: PRICE_SQL, params: ['AAPL'] });
+  const write = await post('/batch', { statements: [insertPrice('price_history', 'AAPL', '2024-01-03', 184)] });
+  const after = await post('/query', { sql: PRICE_SQL, params: ['AAPL'] });
+
+  assert.equal(write.status, 200);
+  assert.equal(fake.getGeneration(), 1);
+  assert.equal(after.cacheStatus, 'MISS');
+  assert.equal(after.json.results.length, 2);
+});
+
+test('a single-statement /query write also bumps the generation', async () => {
+  const { fake, post } = setup();
+
+  await post('/query', { sql: PRICE_SQL, params: ['AAPL'] });
+  const write = await post('/query', insertPrice('price_history', 'AAPL', '2024-01-03', 184));
+  const after = await post('/query', { sql: PRICE_SQL, params: ['AAPL'] });
+
+  assert.equal(write.cacheStatus, 'BYPASS');
+  assert.equal(fake.getGeneration(), 1);
+  assert.equal(after.cacheStatus, 'MISS');
+  assert.deepEqual(after.json.results, [{ symbol: 'AAPL', date: '2024-01-03', price: 184 }]);
+});
+
+test('the weekend ALTER TABLE ... RENAME swap invalidates cached reads', async () => {
+  const { fake, post } = setup();
+  fake.tables.price_history.push({ symbol: 'AAPL', date: '2024-01-02', price: 185 });
+  fake.tables.price_history_temp.push({ symbol: 'AAPL', date: '2024-01-02', price: 185.5 });
+
+  const before = await post('/query', { sql: PRICE_SQL, params: ['AAPL'] });
+  await post('/batch', { statements: [
+    { sql: 'DROP TABLE IF EXISTS price_history' },
+    { sql: 'ALTER TABLE price_history_temp RENAME TO price_history' },
+  ] });
+  const after = await post('/query', { sql: PRICE_SQL, params: ['AAPL'] });
+
+  assert.equal(before.json.results[0].price, 185);
+  assert.equal(fake.getGeneration(), 1);
+  assert.equal(after.cacheStatus, 'MISS');
+  assert.equal(after.json.results[0].price, 185.5);
+});
+
+test('queries touching transactions or intraday_quotes bypass the cache', async () => {
+  const { post, countRuns } = setup();
+  const joinTransactions = 'SELECT p.date, p.price FROM price_history p JOIN transactions t ON t.symbol = p.symbol WHERE p.symbol = ?';
+  const intraday = 'SELECT price FROM intraday_quotes WHERE symbol = ?';
+
+  for (const sql of [joinTransactions, intraday]) {
+    const first = await post('/query', { sql, params: ['AAPL'] });
+    const second = await post('/query', { sql, params: ['AAPL'] });
+    assert.equal(first.cacheStatus, 'BYPASS');
+    assert.equal(second.cacheStatus, 'BYPASS');
+    assert.equal(countRuns(sql), 2);
+  }
+});
+
+test('/batch results exclude the appended generation bump', async () => {
+  const { cache, post } = setup();
+
+  const { json } = await post('/batch', { statements: [
+    insertPrice('price_history', 'AAPL', '2024-01-02', 185),
+    insertPrice('price_history', 'MSFT', '2024-01-02', 370),
+  ] });
+
+  assert.equal(json.success, true);
+  assert.equal(json.results.length, 2);
+  assert.equal(cache.snapshot().generationBumps, 1);
+});
+
+test('/batch without market data writes does not bump the generation', async () => {
+  const { fake, post } = setup();
+
+  const { json } = await post('/batch', { statements: [{ sql: 'SELECT price FROM intraday_quotes WHERE symbol = ?', params: ['AAPL'] }] });
+
+  assert.equal(json.results.length, 1);
+  assert.equal(fake.getGeneration(), null);
+});
@@ -1,56 +1,239 @@
 // =========================================================================================
-// == Cloudflare D1 Proxy Worker 完整程式碼 (v1.2 - 最終穩健版)
+// == Cloudflare D1 Proxy Worker 完整程式碼 (v1.3 - 市場數據讀取快取)
 // =========================================================================================
 
-export default {
-  async fetch(request, env, ctx) {
-    // [最終修正] 只宣告一次 pathname，並加入日誌
-    console.log(`[DEBUG] Incoming request URL: ${request.url}`);
-    const { pathname } = new URL(request.url);
-    console.log(`[DEBUG] Parsed pathname: ${pathname}`);
-
-    // 只接受 POST 請求
-    if (request.method !== 'POST') {
-      return new Response('Method Not Allowed', { status: 405 });
-    }
+// ========================= 【市場數據讀取快取 - 開始】 =========================
+// == 市場數據表只會在 main.py / main_weekend.py (以及後端補抓缺漏數據) 寫入時變動，
+// == 因此針對只讀取這些表的 SELECT 以 SQL + params 為鍵做讀穿快取。
+// == 失效以 D1 中的世代計數器 (market_data_generation) 判斷：任何經由本 Worker 寫入市場數據表的
+// == /batch 會在同一批次內原子性遞增計數器，表替換 (ALTER TABLE ... RENAME) 亦同。
+// =========================================================================================
+const MARKET_DATA_TABLES = new Set(['price_history', 'exchange_rates', 'dividend_history', 'market_data_coverage', 'price_history_twd']);
+const MARKET_TABLE_PATTERN = /\b(price_history|exchange_rates|dividend_history|market_data_coverage|price_history_twd)\b/i;
+const WRITE_PATTERN = /^\s*(INSERT|UPDATE|DELETE|REPLACE|ALTER|DROP|CREATE)\b/i;
+const GENERATION_DDL = 'CREATE TABLE IF NOT EXISTS market_data_generation (id INTEGER PRIMARY KEY CHECK (id = 1), generation INTEGER NOT NULL);';
+const GENERATION_SEED_SQL = 'INSERT OR IGNORE INTO market_data_generation (id, generation) VALUES (1, 0);';
+const GENERATION_READ_SQL = 'SELECT generation FROM market_data_generation WHERE id = 1';
+const GENERATION_BUMP_SQL = 'UPDATE market_data_generation SET generation = generation + 1 WHERE id = 1';
+
+/**
+ * 判斷查詢是否可快取：單一 SELECT、所有 FROM/JOIN 的表都屬於市場數據表，且不含與時間或亂數相關的函式
+ */
+function isCacheableQuery(sql) {
+  if (!/^\s*SELECT\b/i.test(sql)) return false;
+  if (/;\s*\S/.test(sql)) return false;
+  if (/\b(now|random|current_date|current_time|current_timestamp)\b/i.test(sql)) return false;
+  // 逗號形式的多表連接不易可靠解析，直接略過快取
+  if (/\b(FROM|JOIN)\s+[A-Za-z_]\w*(\s+(AS\s+)?[A-Za-z_]\w*)?\s*,/i.test(sql)) return false;
+  const tables = [...sql.matchAll(/\b(?:FROM|JOIN)\s+([A-Za-z_]\w*)/gi)].map(m => m[1].toLowerCase());
+  return tables.length > 0 && tables.every(t => MARKET_DATA_TABLES.has(t));
+}
+
+function isMarketDataWrite(sql) {
+  return WRITE_PATTERN.test(sql) && MARKET_TABLE_PATTERN.test(sql);
+}
 
-    // 驗證 API Key
-    const apiKey = request.headers.get('X-API-KEY');
-    if (apiKey !== env.D1_API_KEY) {
-      return new Response('Unauthorized', { status: 401 });
+/**
+ * 建立讀取快取 (每個 Worker isolate 一份，存放於記憶體，依插入順序做 LRU 淘汰)
+ * @param {Object} [options]
+ * @param {number} [options.maxEntries=256] - 最多快取的查詢數
+ * @param {number} [options.maxEntryBytes=2097152] - 單一回應超過此大小則不快取
+ * @param {number} [options.maxTotalBytes=33554432] - 快取總大小上限
+ * @param {number} [options.generationTtlMs=0] - 世代計數器在記憶體中沿用的毫秒數；0 代表每次查詢都向 D1 確認 (不會讀到舊數據)
+ */
+function createQueryCache(options = {}) {
+  const maxEntries = options.maxEntries ?? 256;
+  const maxEntryBytes = options.maxEntryBytes ?? 2 * 1024 * 1024;
+  const maxTotalBytes = options.maxTotalBytes ?? 32 * 1024 * 1024;
+  const generationTtlMs = options.generationTtlMs ?? 0;
+  const now = options.now ?? (() => Date.now());
+
+  const entries = new Map();
+  const stats = { hits: 0, misses: 0, bypasses: 0, stores: 0, evictions: 0, generationBumps: 0 };
+  let totalBytes = 0;
+  let generationTableReady = null;
+  let knownGeneration = null;
+  let knownGenerationAt = 0;
+
+  const ensureGenerationTable = (db) => {
+    if (!generationTableReady) {
+      generationTableReady = db.batch([db.prepare(GENERATION_DDL), db.prepare(GENERATION_SEED_SQL)])
+        .catch(e => { generationTableReady = null; throw e; });
     }
+    return generationTableReady;
+  };
 
-    try {
-      // [最終修正] 使用 .endsWith() 進行路由判斷，使其對 /query 和 //query 都有彈性
-      if (pathname.endsWith('/query')) {
-        const { sql, params = [] } = await request.json();
-        if (!sql) {
-          return new Response(JSON.stringify({ success: false, error: 'SQL query is missing' }), { status: 400, headers: { 'Content-Type': 'application/json' } });
-        }
-        
-        const stmt = env.DB.prepare(sql).bind(...params);
-        const { results } = await stmt.all();
-        
-        return new Response(JSON.stringify({ success: true, results: results }), { headers: { 'Content-Type': 'application/json' } });
-
-      } else if (pathname.endsWith('/batch')) {
-        const { statements } = await request.json();
-        if (!statements || !Array.isArray(statements)) {
-            return new Response(JSON.stringify({ success: false, error: 'Statements array is missing or invalid' }), { status: 400, headers: { 'Content-Type': 'application/json' } });
+  const readGeneration = async (db) => {
+    if (knownGeneration !== null && now() - knownGenerationAt < generationTtlMs) return knownGeneration;
+    await ensureGenerationTable(db);
+    const row = await db.prepare(GENERATION_READ_SQL).first();
+    knownGeneration = row ? Number(row.generation) : 0;
+    knownGenerationAt = now();
+    return knownGeneration;
+  };
+
+  const evict = (key) => {
+    const entry = entries.get(key);
+    if (!entry) return;
+    totalBytes -= entry.body.length;
+    entries.delete(key);
+  };
+
+  return {
+    stats,
+    ensureGenerationTable,
+    bumpStatement: (db) => db.prepare(GENERATION_BUMP_SQL),
+
+    /** 本 isolate 剛寫入市場數據，下一次查詢必須重新讀取世代計數器 */
+    noteGenerationBump() {
+      stats.generationBumps++;
+      knownGeneration = null;
+    },
+
+    /**
+     * 讀穿快取：命中時直接回傳序列化好的回應內容，否則執行 runQuery 並存入
+     * @returns {Promise<{body: string, status: 'HIT'|'MISS'|'BYPASS'}>}
+     */
+    async read(db, sql, params, runQuery) {
+      if (!isCacheableQuery(sql)) {
+        stats.bypasses++;
+        return { body: await runQuery(), status: 'BYPASS' };
+      }
+      // 先讀取世代再執行查詢：若查詢期間有寫入，存入的條目會帶著舊世代，下一次查詢即視為失效
+      const generation = await readGeneration(db);
+      const key = JSON.stringify([sql, params]);
+      const cached = entries.get(key);
+      if (cached && cached.generation === generation) {
+        stats.hits++;
+        entries.delete(key);
+        entries.set(key, cached);
+        return { body: cached.body, status: 'HIT' };
+      }
+      stats.misses++;
+      evict(key);
+      const body = await runQuery();
+      if (body.length <= maxEntryBytes) {
+        entries.set(key, { generation, body });
+        totalBytes += body.length;
+        stats.stores++;
+        while (entries.size > maxEntries || totalBytes > maxTotalBytes) {
+          evict(entries.keys().next().value);
+          stats.evictions++;
         }
+      }
+      return { body, status: 'MISS' };
+    },
+
+    snapshot() {
+      return { ...stats, entries: entries.size, bytes: totalBytes, generation: knownGeneration };
+    }
+  };
+}
+
+function cacheOptionsFromEnv(env) {
+  const toNumber = (value) => (value === undefined || value === '' ? undefined : Number(value));
+  return {
+    maxEntries: toNumber(env.QUERY_CACHE_MAX_ENTRIES),
+    maxEntryBytes: toNumber(env.QUERY_CACHE_MAX_ENTRY_BYTES),
+    maxTotalBytes: toNumber(env.QUERY_CACHE_MAX_TOTAL_BYTES),
+    generationTtlMs: toNumber(env.QUERY_CACHE_GENERATION_TTL_MS),
+  };
+}
+
+let isolateCache = null;
+
+// ========================= 【市場數據讀取快取 - 結束】 =========================
 
-        const preparedStatements = statements.map(stmt => env.DB.prepare(stmt.sql).bind(...(stmt.params || [])));
-        const results = await env.DB.batch(preparedStatements);
-        
-        return new Response(JSON.stringify({ success: true, results: results }), { headers: { 'Content-Type': 'application/json' } });
+const jsonResponse = (body, init = {}) => new Response(body, { ...init, headers: { 'Content-Type': 'application/json', ...(init.headers || {}) } });
+
+/**
+ * 處理單一請求。env.DB 只需提供 prepare().bind().all()/first() 與 batch()，本地可傳入替身 (例如以 SQLite 實作的物件) 進行測試
+ * @param {Object|null} cache - createQueryCache() 的回傳值；null 代表停用快取
+ */
+async function handleRequest(request, env, cache) {
+  // [最終修正] 只宣告一次 pathname，並加入日誌
+  console.log(`[DEBUG] Incoming request URL: ${request.url}`);
+  const { pathname } = new URL(request.url);
+  console.log(`[DEBUG] Parsed pathname: ${pathname}`);
+
+  // 只接受 POST 請求
+  if (request.method !== 'POST') {
+    return new Response('Method Not Allowed', { status: 405 });
+  }
+
+  // 驗證 API Key
+  const apiKey = request.headers.get('X-API-KEY');
+  if (apiKey !== env.D1_API_KEY) {
+    return new Response('Unauthorized', { status: 401 });
+  }
+
+  try {
+    // [最終修正] 使用 .endsWith() 進行路由判斷，使其對 /query 和 //query 都有彈性
+    if (pathname.endsWith('/cache/stats')) {
+      return jsonResponse(JSON.stringify({ success: true, enabled: !!cache, results: cache ? cache.snapshot() : null }));
+
+    } else if (pathname.endsWith('/query')) {
+      const { sql, params = [] } = await request.json();
+      if (!sql) {
+        return jsonResponse(JSON.stringify({ success: false, error: 'SQL query is missing' }), { status: 400 });
+      }
+
+      const runQuery = async () => {
+        const { results } = await env.DB.prepare(sql).bind(...params).all();
+        return JSON.stringify({ success: true, results: results });
+      };
+
+      if (!cache) {
+        return jsonResponse(await runQuery());
+      }
+      if (isMarketDataWrite(sql)) {
+        await cache.ensureGenerationTable(env.DB);
+        const [{ results }] = await env.DB.batch([env.DB.prepare(sql).bind(...params), cache.bumpStatement(env.DB)]);
+        cache.noteGenerationBump();
+        return jsonResponse(JSON.stringify({ success: true, results: results }), { headers: { 'X-Cache': 'BYPASS' } });
+      }
+      const { body, status } = await cache.read(env.DB, sql, params, runQuery);
+      return jsonResponse(body, { headers: { 'X-Cache': status } });
+
+    } else if (pathname.endsWith('/batch')) {
+      const { statements } = await request.json();
+      if (!statements || !Array.isArray(statements)) {
+          return jsonResponse(JSON.stringify({ success: false, error: 'Statements array is missing or invalid' }), { status: 400 });
+      }
+
+      const preparedStatements = statements.map(stmt => env.DB.prepare(stmt.sql).bind(...(stmt.params || [])));
+      // 寫入市場數據表的批次在同一個交易內遞增世代計數器，批次失敗時計數器也不會變動
+      const touchesMarketData = !!cache && statements.some(stmt => isMarketDataWrite(stmt.sql || ''));
+      if (touchesMarketData) {
+        await cache.ensureGenerationTable(env.DB);
+        preparedStatements.push(cache.bumpStatement(env.DB));
       }
+      const results = await env.DB.batch(preparedStatements);
+      if (touchesMarketData) cache.noteGenerationBump();
+
+      return jsonResponse(JSON.stringify({ success: true, results: results.slice(0, statements.length) }));
+    }
 
-      // 如果路徑不匹配 /query 或 /batch，則回傳 404
-      return new Response('Not Found', { status: 404 });
+    // 如果路徑不匹配 /query 或 /batch，則回傳 404
+    return new Response('Not Found', { status: 404 });
 
-    } catch (e) {
-      console.error('D1 Worker Error:', e);
-      return new Response(JSON.stringify({ success: false, error: e.message }), { status: 500, headers: { 'Content-Type': 'application/json' } });
+  } catch (e) {
+    console.error('D1 Worker Error:', e);
+    return jsonResponse(JSON.stringify({ success: false, error: e.message }), { status: 500 });
+  }
+}
+
+export { createQueryCache, handleRequest, isCacheableQuery, isMarketDataWrite };
+
+export default {
+  async fetch(request, env, ctx) {
+    // 設定 QUERY_CACHE_ENABLED = "false" 可停用快取
+    if (env.QUERY_CACHE_ENABLED === 'false') {
+      return handleRequest(request, env, null);
+    }
+    if (!isolateCache) {
+      isolateCache = createQueryCache(cacheOptionsFromEnv(env));
     }
+    return handleRequest(request, env, isolateCache);
   },
 };